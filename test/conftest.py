@@ -14,6 +14,46 @@ DATADIR = Path(__file__).parent / 'data'
 DBURI = 'postgresql://localhost:5433/postgres'
 
 
+def pytest_addoption(parser):
+    parser.addoption(
+        '--bench', action='store_true', default=False,
+        help='run the benchmarks'
+    )
+    parser.addoption(
+        '--bench-quick', action='store_true', default=False,
+        help='restrict the benchmark sweeps to the small sizes'
+    )
+    parser.addoption(
+        '--bench-output', default=None,
+        help='write the benchmark results to this json file'
+    )
+    parser.addoption(
+        '--bench-baseline', default=None,
+        help='flag the regressions against this json file '
+        '(written by a previous --bench-output run)'
+    )
+    parser.addoption(
+        '--bench-tolerance', type=float, default=.25,
+        help='relative slowdown (or memory growth) tolerated '
+        'against the baseline'
+    )
+
+
+def pytest_configure(config):
+    config.addinivalue_line(
+        'markers', 'bench: a benchmark, only run with --bench'
+    )
+
+
+def pytest_collection_modifyitems(config, items):
+    if config.getoption('--bench'):
+        return
+    skip = pytest.mark.skip(reason='benchmarks need --bench')
+    for item in items:
+        if 'bench' in item.keywords:
+            item.add_marker(skip)
+
+
 def handler():
     try:
         from tshistory_formula.tsio import timeseries
@@ -33,6 +73,9 @@ def engine(request):
     sch.create(e)
     sch = schema.tsschema(ns='other')
     sch.create(e)
+    # a secondary source made slow by the tests
+    sch = schema.tsschema(ns='slow')
+    sch.create(e)
 
     if util.has_formula():
         from tshistory_formula.schema import formula_schema
@@ -64,3 +107,19 @@ def client(engine):
         )
     )
     yield WebTester(wsgi)
+
+
+@pytest.fixture(scope='session')
+def cacheclient(engine):
+    wsgi = app.make_app(
+        api.timeseries(
+            str(engine.url),
+            handler=handler(),
+            namespace='tsh',
+            sources=[(DBURI, 'other')]
+        ),
+        cache_size=16,
+        cache_ttl=600,
+        catalog_ttl=600
+    )
+    yield WebTester(wsgi)
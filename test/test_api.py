@@ -1,10 +1,18 @@
+from datetime import datetime
+import gzip
 import json
+import threading
+import time
+from unittest.mock import patch
+from urllib.parse import urlencode
+import warnings
 import zlib
 
 import pandas as pd
 import pytest
+import webtest
 
-from tshistory import util, tsio
+from tshistory import api, util, tsio
 from tshistory.testutil import (
     assert_df,
     assert_hist,
@@ -12,6 +20,9 @@ from tshistory.testutil import (
     genserie
 )
 
+from tshistory_rest import app, util as rutil
+from tshistory_rest.cache import lrucache, singleflight
+
 
 def has_formula():
     try:
@@ -675,3 +686,2079 @@ def test_formula(client, engine):
 
     res = client.get('/series/formula?name=new-formula')
     assert res.json == '(+ 3 (series "test-formula"))'
+
+
+def test_binary_patch(client):
+    series_in = genserie(utcdt(2020, 1, 1), 'H', 3)
+    query = urlencode({
+        'name': 'test-binary',
+        'author': 'Babar',
+        'insertion_date': utcdt(2020, 1, 1, 10)
+    })
+    res = client.patch(
+        f'/series/state?{query}',
+        rutil.binary_pack_meta_data(
+            rutil.series_metadata(series_in),
+            series_in
+        ),
+        content_type='application/octet-stream'
+    )
+    assert res.status_code == 201
+
+    res = client.get('/series/state', params={
+        'name': 'test-binary',
+        'format': 'tshpack'
+    })
+    meta, series = rutil.binary_unpack_meta_data(res.body)
+    assert meta['tzaware']
+    assert_df("""
+2020-01-01 00:00:00+00:00    0.0
+2020-01-01 01:00:00+00:00    1.0
+2020-01-01 02:00:00+00:00    2.0
+""", series)
+
+    strseries = pd.Series(
+        ['a', 'b', None],
+        index=pd.date_range(utcdt(2020, 1, 1), freq='D', periods=3)
+    )
+    query = urlencode({
+        'name': 'test-binary-str',
+        'author': 'Babar',
+        'insertion_date': utcdt(2020, 1, 1, 10)
+    })
+    res = client.patch(
+        f'/series/state?{query}',
+        rutil.binary_pack_meta_data(
+            rutil.series_metadata(strseries),
+            strseries
+        ),
+        content_type='application/octet-stream'
+    )
+    assert res.status_code == 201
+
+    res = client.get('/series/state', params={
+        'name': 'test-binary-str',
+        'format': 'tshpack'
+    })
+    meta, series = rutil.binary_unpack_meta_data(res.body)
+    assert meta['value_type'] == 'object'
+    assert series.tolist() == ['a', 'b']
+
+    res = client.patch('/series/state', params={
+        'name': 'test-binary',
+        'author': 'Babar'
+    })
+    assert res.status_code == 400
+    assert res.json == {
+        'message': '`test-binary`: no series provided'
+    }
+
+    for body in (b'garbage', zlib.compress(b'garbage')):
+        res = client.patch(
+            f'/series/state?{query}',
+            body,
+            content_type='application/octet-stream'
+        )
+        assert res.status_code == 400
+        assert res.json == {
+            'message': '`test-binary-str`: bad tshpack payload'
+        }
+
+
+def test_bulk_get(client):
+    for name in ('bulk-a', 'bulk-b'):
+        series = genserie(utcdt(2020, 1, 1), 'D', 3)
+        res = client.patch('/series/state', params={
+            'name': name,
+            'series': util.tojson(series),
+            'author': 'Babar',
+            'insertion_date': utcdt(2020, 1, 1, 10),
+            'tzaware': util.tzaware_serie(series)
+        })
+        assert res.status_code == 201
+
+    res = client.get('/series/bulk', params=[
+        ('name', 'bulk-a'),
+        ('name', 'no-such-series'),
+        ('name', 'bulk-b'),
+        ('from_value_date', utcdt(2020, 1, 2))
+    ])
+    assert res.json == {
+        'series': {
+            'bulk-a': {
+                '2020-01-02T00:00:00.000Z': 1.0,
+                '2020-01-03T00:00:00.000Z': 2.0
+            },
+            'bulk-b': {
+                '2020-01-02T00:00:00.000Z': 1.0,
+                '2020-01-03T00:00:00.000Z': 2.0
+            }
+        },
+        'missing': ['no-such-series']
+    }
+
+    res = client.get('/series/bulk', params=[
+        ('name', 'bulk-a'),
+        ('name', 'no-such-series'),
+        ('name', 'bulk-b'),
+        ('format', 'tshpack')
+    ])
+    header, entries = rutil.binary_unpack_many(res.body)
+    assert header == {'missing': ['no-such-series']}
+    assert [entry['name'] for entry, _ in entries] == ['bulk-a', 'bulk-b']
+    meta, series = entries[1]
+    assert meta['meta']['tzaware']
+    assert_df("""
+2020-01-01 00:00:00+00:00    0.0
+2020-01-02 00:00:00+00:00    1.0
+2020-01-03 00:00:00+00:00    2.0
+""", series)
+
+    # before the first insertion, the series exist but are empty
+    res = client.get('/series/bulk', params=[
+        ('name', 'bulk-a'),
+        ('insertion_date', utcdt(2019, 1, 1)),
+        ('format', 'tshpack')
+    ])
+    header, entries = rutil.binary_unpack_many(res.body)
+    assert header == {'missing': []}
+    assert len(entries[0][1]) == 0
+
+
+def test_bulk_update(client):
+    series = genserie(utcdt(2020, 1, 1), 'D', 3)
+    meta = rutil.series_metadata(series)
+    query = urlencode({
+        'author': 'Babar',
+        'insertion_date': utcdt(2020, 1, 2)
+    })
+    res = client.patch(
+        f'/series/bulk?{query}',
+        rutil.binary_pack_many({}, [
+            ({'name': 'bulk-new', 'meta': meta}, series),
+            ({'name': 'bulk-a', 'meta': meta}, series),
+            ({'name': 'bulk-b', 'meta': meta},
+             genserie(utcdt(2020, 1, 4), 'D', 1, [3])),
+            ({'name': 'bulk-replaced', 'meta': meta,
+              'metadata': {'origin': 'bulk'}, 'replace': True}, series),
+        ]),
+        content_type='application/octet-stream'
+    )
+    assert res.status_code == 200
+    assert res.json == {
+        'bulk-new': 'created',
+        'bulk-a': 'unchanged',
+        'bulk-b': 'updated',
+        'bulk-replaced': 'created'
+    }
+
+    res = client.get('/series/state', params={
+        'name': 'bulk-b'
+    })
+    assert res.json == {
+        '2020-01-01T00:00:00.000Z': 0.0,
+        '2020-01-02T00:00:00.000Z': 1.0,
+        '2020-01-03T00:00:00.000Z': 2.0,
+        '2020-01-04T00:00:00.000Z': 3.0
+    }
+
+    # all or nothing
+    res = client.patch(
+        f'/series/bulk?{query}',
+        rutil.binary_pack_many({}, [
+            ({'name': 'bulk-rollback', 'meta': meta}, series),
+            ({'name': 'test-other-source', 'meta': meta}, series),
+        ]),
+        content_type='application/octet-stream'
+    )
+    assert res.status_code == 405
+    assert res.json == {'message': 'not allowed to update to a secondary source'}
+
+    res = client.get('/series/state?name=bulk-rollback')
+    assert res.status_code == 404
+
+    res = client.patch('/series/bulk', params={'author': 'Babar'})
+    assert res.status_code == 400
+
+    for body, message in (
+            (b'garbage', 'bad tshpack payload'),
+            (rutil.binary_pack_many({}, [({'meta': meta}, series)]),
+             'all the entries must have a name'),
+            (rutil.binary_pack_many({}, [
+                ({'name': 'bulk-a', 'meta': meta}, series),
+                ({'name': 'bulk-b', 'meta': meta}, series),
+                ({'name': 'bulk-a', 'meta': meta}, series)
+            ]), 'duplicated names: bulk-a')):
+        res = client.patch(
+            f'/series/bulk?{query}',
+            body,
+            content_type='application/octet-stream'
+        )
+        assert res.status_code == 400
+        assert res.json == {'message': message}
+
+
+def test_history_stream(client):
+    for params in (
+            {},
+            {'diffmode': True},
+            {'diffmode': True,
+             'from_insertion_date': utcdt(2015, 1, 2)},
+            {'from_insertion_date': utcdt(2015, 1, 2),
+             'to_insertion_date': utcdt(2015, 1, 3)},
+            {'from_value_date': utcdt(2015, 1, 2, 3),
+             'to_value_date': utcdt(2015, 1, 2, 5)}):
+        res = client.get('/series/history', params={
+            'name': 'staircase',
+            'format': 'tshpack',
+            **params
+        })
+        _meta, expected = util.unpack_history(res.body)
+
+        res = client.get('/series/history', params={
+            'name': 'staircase',
+            'format': 'tshpack',
+            'stream': True,
+            **params
+        })
+        assert res.content_type == 'application/octet-stream'
+        meta, hist = rutil.unpack_history_stream(res.body)
+        assert meta['tzaware']
+        assert list(hist) == list(expected)
+        for idate, series in hist.items():
+            assert series.equals(expected[idate])
+
+    res = client.get('/series/history', params={
+        'name': 'staircase',
+        'from_insertion_date': utcdt(2015, 1, 3),
+        'stream': True
+    })
+    assert res.content_type == 'application/x-ndjson'
+    lines = [json.loads(line) for line in res.text.splitlines()]
+    assert [list(line) for line in lines] == [
+        ['2015-01-03T00:00:00+00:00'],
+        ['2015-01-04T00:00:00+00:00']
+    ]
+    assert lines[0]['2015-01-03T00:00:00+00:00'][
+        '2015-01-03T06:00:00.000Z'
+    ] == 6.0
+
+    if not has_formula():
+        return
+
+    # formulas have no revision-wise reads
+    res = client.patch('/series/formula', params={
+        'name': 'staircase-formula',
+        'text': '(+ 1 (series "staircase"))'
+    })
+    assert res.status_code == 201
+    for params in (
+            {},
+            {'from_insertion_date': utcdt(2015, 1, 2),
+             'to_insertion_date': utcdt(2015, 1, 3)}):
+        res = client.get('/series/history', params={
+            'name': 'staircase-formula',
+            'format': 'tshpack',
+            **params
+        })
+        _meta, expected = util.unpack_history(res.body)
+        assert len(expected)
+
+        res = client.get('/series/history', params={
+            'name': 'staircase-formula',
+            'format': 'tshpack',
+            'stream': True,
+            **params
+        })
+        _meta, hist = rutil.unpack_history_stream(res.body)
+        assert list(hist) == list(expected)
+        for idate, series in hist.items():
+            assert series.equals(expected[idate])
+
+
+def test_conditional_get(client):
+    series = genserie(utcdt(2020, 1, 1), 'D', 3)
+    res = client.patch('/series/state', params={
+        'name': 'test-etag',
+        'series': util.tojson(series),
+        'author': 'Babar',
+        'insertion_date': utcdt(2020, 1, 1, 10),
+        'tzaware': util.tzaware_serie(series)
+    })
+    assert res.status_code == 201
+
+    for route, params in (
+            ('state', {}),
+            ('state', {'format': 'tshpack'}),
+            ('history', {}),
+            ('staircase', {'delta': 'PT1H'})):
+        url = f'/series/{route}'
+        params = {'name': 'test-etag', **params}
+        res = client.get(url, params=params)
+        assert res.status_code == 200
+        etag = res.headers['ETag']
+        assert res.headers['Last-Modified'] == 'Wed, 01 Jan 2020 10:00:00 GMT'
+
+        res = client.get(url, params=params, headers={
+            'If-None-Match': etag
+        })
+        assert res.status_code == 304
+        assert res.body == b''
+        assert res.headers['ETag'] == etag
+
+        res = client.get(url, params=params, headers={
+            'If-Modified-Since': 'Wed, 01 Jan 2020 10:00:00 GMT'
+        })
+        assert res.status_code == 304
+
+        # other bounds, other validator
+        res = client.get(url, params={
+            'from_value_date': utcdt(2020, 1, 2),
+            'to_value_date': utcdt(2020, 1, 3),
+            **params
+        }, headers={
+            'If-None-Match': etag
+        })
+        assert res.status_code == 200
+        assert res.headers['ETag'] != etag
+
+    res = client.get('/series/state?name=test-etag')
+    etag = res.headers['ETag']
+
+    series = genserie(utcdt(2020, 1, 4), 'D', 1, [3])
+    res = client.patch('/series/state', params={
+        'name': 'test-etag',
+        'series': util.tojson(series),
+        'author': 'Babar',
+        'insertion_date': utcdt(2020, 1, 2, 10),
+        'tzaware': util.tzaware_serie(series)
+    })
+    assert res.status_code == 200
+
+    res = client.get('/series/state?name=test-etag', headers={
+        'If-None-Match': etag
+    })
+    assert res.status_code == 200
+    assert res.headers['ETag'] != etag
+    assert len(res.json) == 4
+
+    res = client.get('/series/state?name=test-etag', headers={
+        'If-Modified-Since': 'Wed, 01 Jan 2020 10:00:00 GMT'
+    })
+    assert res.status_code == 200
+
+    # the entity tag wins over the modification date
+    res = client.get('/series/state?name=test-etag', headers={
+        'If-None-Match': etag,
+        'If-Modified-Since': 'Thu, 02 Jan 2020 10:00:00 GMT'
+    })
+    assert res.status_code == 200
+
+    # a metadata change is a modification
+    etag = res.headers['ETag']
+    res = client.put('/series/metadata', params={
+        'name': 'test-etag',
+        'metadata': json.dumps({'freq': 'D'})
+    })
+    assert res.status_code == 200
+    res = client.get('/series/state?name=test-etag', headers={
+        'If-Modified-Since': 'Thu, 02 Jan 2020 10:00:00 GMT'
+    })
+    assert res.status_code == 200
+    assert res.headers['ETag'] != etag
+    assert res.headers['Last-Modified'] != 'Thu, 02 Jan 2020 10:00:00 GMT'
+
+    # series from a secondary source have no validator
+    res = client.get('/series/state?name=test-other-source')
+    assert res.status_code == 200
+    assert 'ETag' not in res.headers
+
+
+def test_cache(cacheclient):
+    client = cacheclient
+    series = genserie(utcdt(2020, 1, 1), 'D', 3)
+    res = client.patch('/series/state', params={
+        'name': 'test-cache',
+        'series': util.tojson(series),
+        'author': 'Babar',
+        'insertion_date': utcdt(2020, 1, 1, 10),
+        'tzaware': util.tzaware_serie(series)
+    })
+    assert res.status_code == 201
+
+    res = client.get('/series/cache')
+    assert res.json == {
+        'hits': 0,
+        'misses': 0,
+        'entries': 0,
+        'maxsize': 16,
+        'ttl': 600
+    }
+
+    for _ in range(3):
+        res = client.get('/series/state?name=test-cache')
+        assert len(res.json) == 3
+        etag = res.headers['ETag']
+    res = client.get('/series/state?name=test-cache&format=tshpack')
+    _meta, series = rutil.binary_unpack_meta_data(res.body)
+    assert len(series) == 3
+    res = client.get('/series/state?name=test-cache', headers={
+        'If-None-Match': etag
+    })
+    assert res.status_code == 304
+
+    stats = client.get('/series/cache').json
+    assert stats['hits'] == 3
+    assert stats['misses'] == 2
+    assert stats['entries'] == 2
+
+    # an update drops the series entries
+    series = genserie(utcdt(2020, 1, 4), 'D', 1, [3])
+    res = client.patch('/series/state', params={
+        'name': 'test-cache',
+        'series': util.tojson(series),
+        'author': 'Babar',
+        'insertion_date': utcdt(2020, 1, 2, 10),
+        'tzaware': util.tzaware_serie(series)
+    })
+    assert client.get('/series/cache').json['entries'] == 0
+    res = client.get('/series/state?name=test-cache')
+    assert len(res.json) == 4
+
+    # so does a metadata update
+    res = client.put('/series/metadata', params={
+        'name': 'test-cache',
+        'metadata': json.dumps({'unit': 'banana'})
+    })
+    assert res.status_code == 200
+    assert client.get('/series/cache').json['entries'] == 0
+    res = client.get('/series/state?name=test-cache&format=tshpack')
+    meta, _series = rutil.binary_unpack_meta_data(res.body)
+    assert meta['unit'] == 'banana'
+
+    # and a rename
+    res = client.put('/series/state', params={
+        'name': 'test-cache',
+        'newname': 'test-cache-renamed'
+    })
+    assert res.status_code == 204
+    res = client.get('/series/state?name=test-cache&format=tshpack')
+    assert res.status_code == 404
+
+    # and a delete
+    res = client.get('/series/state?name=test-cache-renamed')
+    assert res.status_code == 200
+    res = client.delete('/series/state?name=test-cache-renamed')
+    assert res.status_code == 204
+    res = client.get('/series/state?name=test-cache-renamed')
+    assert res.status_code == 404
+
+
+def test_lrucache():
+    cache = lrucache(maxsize=2, ttl=600)
+    cache.set('a', ('a', 1), 'a1')
+    cache.set('a', ('a', 2), 'a2')
+    assert cache.get(('a', 1)) == 'a1'
+    cache.set('b', ('b', 1), 'b1')
+    # ('a', 2) was the least recently used
+    assert cache.get(('a', 2)) is None
+    assert len(cache) == 2
+
+    cache.invalidate('a')
+    assert cache.get(('a', 1)) is None
+    assert cache.get(('b', 1)) == 'b1'
+    assert cache.stats()['hits'] == 2
+    assert cache.stats()['misses'] == 2
+
+    cache = lrucache(maxsize=2, ttl=0)
+    cache.set('a', ('a', 1), 'a1')
+    assert cache.get(('a', 1)) is None
+    assert len(cache) == 0
+
+    # a value read across an invalidation is refused
+    cache = lrucache(maxsize=2, ttl=600)
+    generation = cache.generation('a', 'b')
+    cache.invalidate('b')
+    assert not cache.set('a', ('a', 1), 'a1', depends=('b',),
+                         generation=generation)
+    assert cache.get(('a', 1)) is None
+    generation = cache.generation('a', 'b')
+    cache.invalidate('c')
+    assert cache.set('a', ('a', 1), 'a1', depends=('b',),
+                     generation=generation)
+    assert cache.get(('a', 1)) == 'a1'
+
+
+def test_catalog_filter_and_pages(client):
+    res = client.get('/series/catalog', params={
+        'pattern': 'bulk-*'
+    })
+    assert res.json == {
+        'db://localhost:5433/postgres!tsh': [
+            ['bulk-a', 'primary'],
+            ['bulk-b', 'primary'],
+            ['bulk-new', 'primary'],
+            ['bulk-replaced', 'primary']
+        ]
+    }
+
+    res = client.get('/series/catalog', params={
+        'pattern': 'test-other*',
+        'kind': 'primary'
+    })
+    assert res.json == {
+        'db://localhost:5433/postgres!other': [
+            ['test-other-source', 'primary']
+        ]
+    }
+
+    res = client.get('/series/catalog', params={
+        'pattern': '*',
+        'kind': 'formula'
+    })
+    assert all(
+        kind == 'formula'
+        for series in res.json.values()
+        for _name, kind in series
+    )
+
+    names = []
+    params = {'pattern': '*bulk*', 'limit': 3}
+    while True:
+        res = client.get('/series/catalog', params=params)
+        assert sum(len(series) for series in res.json.values()) <= 3
+        names += [
+            name
+            for series in res.json.values()
+            for name, _kind in series
+        ]
+        if 'X-Next-Cursor' not in res.headers:
+            break
+        params['cursor'] = res.headers['X-Next-Cursor']
+    assert names == ['bulk-a', 'bulk-b', 'bulk-new', 'bulk-replaced']
+
+    res = client.get('/series/catalog', params={
+        'cursor': 'not-a-cursor'
+    })
+    assert res.status_code == 400
+    for position in (1, ['bulk-a'], ['source', 1]):
+        res = client.get('/series/catalog', params={
+            'cursor': rutil.encode_cursor(position)
+        })
+        assert res.status_code == 400
+
+
+def test_catalog_snapshot(cacheclient, engine):
+    client = cacheclient
+    res = client.get('/series/catalog', params={'pattern': 'snap*'})
+    assert res.json == {}
+
+    # not done through the api: invisible until the snapshot expires
+    tsh = tsio.timeseries('tsh')
+    series = genserie(utcdt(2020, 1, 1), 'D', 3)
+    tsh.update(engine, series, 'snapshot-direct', 'Babar')
+    res = client.get('/series/catalog', params={'pattern': 'snap*'})
+    assert res.json == {}
+
+    res = client.patch('/series/state', params={
+        'name': 'snapshot-api',
+        'series': util.tojson(series),
+        'author': 'Babar',
+        'tzaware': util.tzaware_serie(series)
+    })
+    assert res.status_code == 201
+    res = client.get('/series/catalog', params={'pattern': 'snap*'})
+    assert res.json == {
+        'db://localhost:5433/postgres!tsh': [
+            ['snapshot-direct', 'primary'],
+            ['snapshot-api', 'primary']
+        ]
+    }
+
+    res = client.put('/series/state', params={
+        'name': 'snapshot-api',
+        'newname': 'snapshot-renamed'
+    })
+    res = client.delete('/series/state', params={
+        'name': 'snapshot-direct'
+    })
+    res = client.get('/series/catalog', params={'pattern': 'snap*'})
+    assert res.json == {
+        'db://localhost:5433/postgres!tsh': [
+            ['snapshot-renamed', 'primary']
+        ]
+    }
+
+
+def test_formula_get_on_primary(client):
+    res = client.get('/series/formula?name=bulk-a')
+    if not has_formula():
+        assert res.status_code == 404
+        return
+    assert res.status_code == 409
+    assert res.json['message'] == '`bulk-a` exists but is not a formula'
+
+    res = client.get('/series/formula?name=no-such-series')
+    assert res.status_code == 404
+
+
+def test_content_encoding(client, engine):
+    series = genserie(utcdt(2020, 1, 1), 'H', 24 * 30)
+    res = client.patch('/series/state', params={
+        'name': 'test-encoding',
+        'series': util.tojson(series),
+        'author': 'Babar',
+        'insertion_date': utcdt(2020, 1, 1),
+        'tzaware': util.tzaware_serie(series)
+    })
+    assert res.status_code == 201
+
+    # webtest decodes the content by itself
+    client = client.app.test_client()
+    res = client.get('/series/state?name=test-encoding')
+    assert 'Content-Encoding' not in res.headers
+    assert res.headers['Vary'] == 'Accept-Encoding'
+    plain = res.data
+
+    codecs = [
+        ('gzip', gzip.decompress),
+        ('deflate', zlib.decompress)
+    ]
+    if rutil.has_zstd():
+        import zstandard
+        codecs.append(
+            ('zstd', zstandard.ZstdDecompressor().decompress)
+        )
+    for encoding, decode in codecs:
+        res = client.get('/series/state?name=test-encoding', headers={
+            'Accept-Encoding': f'{encoding}, identity;q=0.5'
+        })
+        assert res.headers['Content-Encoding'] == encoding
+        assert len(res.data) < len(plain)
+        assert decode(res.data) == plain
+
+    # unknown or refused encodings
+    res = client.get('/series/state?name=test-encoding', headers={
+        'Accept-Encoding': 'br, gzip;q=0'
+    })
+    assert 'Content-Encoding' not in res.headers
+    assert res.data == plain
+
+    # tshpack is compressed already
+    res = client.get('/series/state?name=test-encoding&format=tshpack', headers={
+        'Accept-Encoding': 'gzip'
+    })
+    assert 'Content-Encoding' not in res.headers
+    _meta, series = rutil.binary_unpack_meta_data(res.data)
+    assert len(series) == 24 * 30
+
+    # a lan deployment
+    lan = app.make_app(
+        api.timeseries(str(engine.url), namespace='tsh'),
+        encodings=('identity',),
+        compresslevel=0
+    ).test_client()
+    res = lan.get('/series/state?name=test-encoding', headers={
+        'Accept-Encoding': 'gzip'
+    })
+    assert 'Content-Encoding' not in res.headers
+    assert res.data == plain
+
+    res = lan.get('/series/state?name=test-encoding&format=tshpack')
+    stored = res.data
+    _meta, series = rutil.binary_unpack_meta_data(stored)
+    assert len(series) == 24 * 30
+    res = client.get('/series/state?name=test-encoding&format=tshpack')
+    assert len(res.data) < len(stored)
+
+    # the levels are checked upfront
+    tsa = api.timeseries(str(engine.url), namespace='tsh')
+    for options in ({'compresslevel': 10}, {'zstdlevel': 0}):
+        with pytest.raises(AssertionError):
+            app.make_app(tsa, **options)
+
+
+@pytest.mark.skipif(
+    not rutil.has_arrow(),
+    reason='pyarrow is not installed'
+)
+def test_arrow(client):
+    import pyarrow as pa
+
+    series = genserie(utcdt(2020, 1, 1), 'D', 3)
+    for idate in (utcdt(2021, 1, 1), utcdt(2021, 1, 2)):
+        res = client.patch('/series/state', params={
+            'name': 'test-arrow',
+            'series': util.tojson(series),
+            'author': 'Babar',
+            'insertion_date': idate,
+            'tzaware': util.tzaware_serie(series)
+        })
+        assert res.status_code in (200, 201)
+        series = genserie(utcdt(2020, 1, 4), 'D', 1, [42])
+
+    res = client.get('/series/state?name=test-arrow&format=arrow')
+    assert res.headers['Content-Type'] == rutil.ARROW_MIMETYPE
+    table = pa.ipc.open_stream(res.body).read_all()
+    assert table.column_names == ['value_date', 'value']
+    meta = json.loads(table.schema.metadata[b'tshistory'])
+    assert meta['tzaware']
+    assert_df("""
+value_date
+2020-01-01 00:00:00+00:00     0.0
+2020-01-02 00:00:00+00:00     1.0
+2020-01-03 00:00:00+00:00     2.0
+2020-01-04 00:00:00+00:00    42.0
+""", table.to_pandas().set_index('value_date')['value'])
+
+    res = client.get('/series/history?name=test-arrow&format=arrow')
+    table = pa.ipc.open_stream(res.body).read_all()
+    assert table.column_names == ['insertion_date', 'value_date', 'value']
+    assert len(table) == 7
+    hist = table.to_pandas().groupby('insertion_date')
+    assert [len(revision) for _, revision in hist] == [3, 4]
+
+    # one record batch per revision
+    res = client.get(
+        '/series/history?name=test-arrow&format=arrow&stream=true'
+    )
+    reader = pa.ipc.open_stream(res.body)
+    assert [len(batch) for batch in reader] == [3, 4]
+
+    res = client.get(
+        '/series/staircase?name=test-arrow&format=arrow&delta=P1D'
+    )
+    table = pa.ipc.open_stream(res.body).read_all()
+    assert table.column_names == ['value_date', 'value']
+
+
+def test_columnar(client):
+    series = genserie(utcdt(2020, 1, 1), 'H', 48)
+    res = client.patch('/series/state', params={
+        'name': 'test-columnar',
+        'series': util.tojson(series),
+        'author': 'Babar',
+        'insertion_date': utcdt(2020, 1, 1),
+        'tzaware': util.tzaware_serie(series)
+    })
+    assert res.status_code == 201
+
+    res = client.get('/series/state?name=test-columnar&format=columnar')
+    assert res.headers['Content-Type'] == 'application/json'
+    payload = res.json
+    assert payload['tzaware']
+    assert 'index' not in payload
+    assert payload['start'] == 1577836800000
+    assert payload['step'] == 3600 * 1000
+    assert payload['length'] == 48
+    assert payload['values'][:3] == [0., 1., 2.]
+    assert rutil.columnar_series(payload).equals(series.astype(float))
+
+    plain = client.get('/series/state?name=test-columnar')
+    assert len(res.body) * 3 < len(plain.body)
+
+    # irregular index
+    sparse = genserie(utcdt(2020, 1, 4), 'D', 1, [42])
+    res = client.patch('/series/state', params={
+        'name': 'test-columnar',
+        'series': util.tojson(sparse),
+        'author': 'Babar',
+        'insertion_date': utcdt(2020, 1, 2),
+        'tzaware': util.tzaware_serie(sparse)
+    })
+    res = client.get('/series/state', params={
+        'name': 'test-columnar',
+        'from_value_date': utcdt(2020, 1, 2, 22),
+        'format': 'columnar'
+    })
+    assert res.json == {
+        'tzaware': True,
+        'index': [1578002400000, 1578006000000, 1578096000000],
+        'values': [46.0, 47.0, 42.0]
+    }
+
+    res = client.get('/series/staircase', params={
+        'name': 'test-columnar',
+        'delta': pd.Timedelta(days=1),
+        'format': 'columnar'
+    })
+    assert len(rutil.columnar_series(res.json)) == 25
+
+    res = client.get('/series/state', params={
+        'name': 'test-columnar',
+        'insertion_date': utcdt(2019, 1, 1),
+        'format': 'columnar'
+    })
+    assert res.json is None
+
+
+def test_history_columnar(client):
+    for day in range(3):
+        # forecasts: each revision covers its own window
+        series = genserie(utcdt(2020, 1, 1 + day), 'H', 4, [day])
+        res = client.patch('/series/state', params={
+            'name': 'test-history-columnar',
+            'series': util.tojson(series),
+            'author': 'Babar',
+            'insertion_date': utcdt(2020, 1, 1 + day),
+            'tzaware': util.tzaware_serie(series)
+        })
+        assert res.status_code in (200, 201)
+
+    res = client.get('/series/history', params={
+        'name': 'test-history-columnar',
+        'format': 'columnar'
+    })
+    assert res.headers['Content-Type'] == 'application/json'
+    assert res.json == {
+        '2020-01-01T00:00:00+00:00': {
+            'tzaware': True, 'start': 1577836800000, 'step': 3600000,
+            'length': 4, 'values': [0.0, 0.0, 0.0, 0.0]
+        },
+        '2020-01-02T00:00:00+00:00': {
+            'tzaware': True, 'index': [
+                1577836800000, 1577840400000, 1577844000000,
+                1577847600000, 1577923200000, 1577926800000,
+                1577930400000, 1577934000000
+            ],
+            'values': [0.0, 0.0, 0.0, 0.0, 1.0, 1.0, 1.0, 1.0]
+        },
+        '2020-01-03T00:00:00+00:00': {
+            'tzaware': True, 'index': [
+                1577836800000, 1577840400000, 1577844000000,
+                1577847600000, 1577923200000, 1577926800000,
+                1577930400000, 1577934000000, 1578009600000,
+                1578013200000, 1578016800000, 1578020400000
+            ],
+            'values': [
+                0.0, 0.0, 0.0, 0.0, 1.0, 1.0, 1.0, 1.0, 2.0, 2.0, 2.0, 2.0
+            ]
+        }
+    }
+
+    res = client.get('/series/history', params={
+        'name': 'test-history-columnar',
+        'diffmode': True,
+        'format': 'columnar',
+        'stream': True
+    })
+    lines = [
+        json.loads(line)
+        for line in res.text.splitlines()
+    ]
+    assert [
+        rutil.columnar_series(payload).tolist()
+        for line in lines
+        for payload in line.values()
+    ] == [[0.] * 4, [1.] * 4, [2.] * 4]
+
+
+def asgi_request(asgi, method, path, query=None, body=b''):
+    " run an http request through an asgi application "
+    scope = {
+        'type': 'http',
+        'http_version': '1.1',
+        'method': method,
+        'scheme': 'http',
+        'path': path,
+        'root_path': '',
+        'query_string': urlencode(query or {}).encode('latin-1'),
+        'headers': [(b'host', b'localhost')],
+        'server': ('localhost', 80),
+        'client': ('127.0.0.1', 4242)
+    }
+    messages = [{'type': 'http.request', 'body': body, 'more_body': False}]
+    sent = []
+
+    async def receive():
+        return messages.pop(0)
+
+    async def send(message):
+        sent.append(message)
+
+    async def run():
+        await asgi(scope, receive, send)
+        return sent
+
+    return run()
+
+
+@pytest.mark.skipif(
+    not rutil.has_a2wsgi(),
+    reason='a2wsgi is not installed'
+)
+def test_asgi(client, engine):
+    import asyncio
+
+    asgi = app.make_asgi_app(
+        api.timeseries(str(engine.url), namespace='tsh'),
+        workers=4,
+        send_timeout=.2
+    )
+
+    async def scenario():
+        series = genserie(utcdt(2020, 1, 1), 'D', 3)
+        for idate in (utcdt(2021, 1, 1), utcdt(2021, 1, 2)):
+            [start, *_] = await asgi_request(
+                asgi, 'PATCH', '/series/state', {
+                    'name': 'test-asgi',
+                    'series': util.tojson(series),
+                    'author': 'Babar',
+                    'insertion_date': idate,
+                    'tzaware': util.tzaware_serie(series)
+                }
+            )
+            assert start['status'] in (200, 201)
+            series = genserie(utcdt(2020, 1, 4), 'D', 1, [42])
+
+        # concurrent reads
+        responses = await asyncio.gather(*[
+            asgi_request(asgi, 'GET', '/series/state', {'name': 'test-asgi'})
+            for _ in range(20)
+        ])
+        for start, *chunks in responses:
+            assert start['status'] == 200
+            assert (b'content-type', b'text/json') in start['headers']
+            assert not chunks[-1].get('more_body')
+            body = b''.join(chunk['body'] for chunk in chunks)
+            assert json.loads(body) == {
+                '2020-01-01T00:00:00.000Z': 0.0,
+                '2020-01-02T00:00:00.000Z': 1.0,
+                '2020-01-03T00:00:00.000Z': 2.0,
+                '2020-01-04T00:00:00.000Z': 42.0
+            }
+
+        # streamed response
+        start, *chunks = await asgi_request(
+            asgi, 'GET', '/series/history', {
+                'name': 'test-asgi',
+                'stream': True
+            }
+        )
+        assert start['status'] == 200
+        assert [
+            chunk.get('more_body', False) for chunk in chunks
+        ] == [True, True, False]
+        lines = b''.join(chunk['body'] for chunk in chunks).splitlines()
+        assert len(lines) == 2
+
+        [start, *_] = await asgi_request(
+            asgi, 'GET', '/series/state', {'name': 'no-such-series'}
+        )
+        assert start['status'] == 404
+
+        # a stalled client does not hold a worker
+        scope = {
+            'type': 'http',
+            'http_version': '1.1',
+            'method': 'GET',
+            'scheme': 'http',
+            'path': '/series/history',
+            'root_path': '',
+            'query_string': b'name=test-asgi&stream=true',
+            'headers': [(b'host', b'localhost')]
+        }
+        sent = []
+
+        async def receive():
+            return {'type': 'http.request', 'body': b'', 'more_body': False}
+
+        async def stalled(message):
+            sent.append(message)
+            if message['type'] == 'http.response.body':
+                await asyncio.sleep(60)
+
+        await asyncio.wait_for(asgi(scope, receive, stalled), 5)
+        assert [message['type'] for message in sent] == [
+            'http.response.start', 'http.response.body'
+        ]
+
+    asyncio.run(scenario())
+
+    # the same state as through the wsgi app
+    res = client.get('/series/state?name=test-asgi')
+    assert len(res.json) == 4
+
+
+def test_metrics(engine):
+    client = webtest.TestApp(
+        app.make_app(
+            api.timeseries(str(engine.url), namespace='tsh'),
+            metrics=True,
+            cache_size=4
+        )
+    )
+    series = genserie(utcdt(2020, 1, 1), 'D', 3)
+    res = client.patch('/series/state', params={
+        'name': 'test-metrics',
+        'series': util.tojson(series),
+        'author': 'Babar',
+        'insertion_date': utcdt(2020, 1, 1),
+        'tzaware': util.tzaware_serie(series)
+    })
+    assert res.status_code == 201
+
+    client.get('/series/state?name=test-metrics')
+    # from the cache
+    client.get('/series/state?name=test-metrics')
+    client.get('/series/state?name=test-metrics&format=tshpack')
+    client.get('/series/state?name=no-such-series', status=404)
+
+    res = client.get('/metrics')
+    assert res.content_type == 'text/plain'
+    lines = res.text.splitlines()
+    for line in (
+            '# TYPE tshistory_rest_requests_total counter',
+            'tshistory_rest_requests_total{route="/series/state",method="GET",status="200"} 3',
+            'tshistory_rest_requests_total{route="/series/state",method="GET",status="404"} 1',
+            'tshistory_rest_requests_total{route="/series/state",method="PATCH",status="201"} 1',
+            'tshistory_rest_errors_total{route="/series/state",status="404"} 1',
+            'tshistory_rest_request_duration_seconds_count{route="/series/state"} 5',
+            'tshistory_rest_points_served_total{route="/series/state",format="json"} 6',
+            'tshistory_rest_points_served_total{route="/series/state",format="tshpack"} 3',
+            'tshistory_rest_series_points_served_total{name="test-metrics"} 9',
+            'tshistory_rest_response_size_bytes_bucket{route="/series/state",format="json",le="256"} 4',
+            'tshistory_rest_response_size_bytes_count{route="/series/state",format="tshpack"} 1'
+    ):
+        assert line in lines
+
+    # not instrumented by default
+    res = webtest.TestApp(
+        app.make_app(api.timeseries(str(engine.url), namespace='tsh'))
+    ).get('/metrics', status=404)
+    assert res.status_code == 404
+
+
+def test_server_timing(client, engine, caplog):
+    series = genserie(utcdt(2020, 1, 1), 'H', 24 * 30)
+    res = client.patch('/series/state', params={
+        'name': 'test-timing',
+        'series': util.tojson(series),
+        'author': 'Babar',
+        'insertion_date': utcdt(2020, 1, 1),
+        'tzaware': util.tzaware_serie(series)
+    })
+    assert res.status_code == 201
+    assert 'Server-Timing' not in res.headers
+
+    def phases(res):
+        return [
+            metric.split(';')[0]
+            for metric in res.headers['Server-Timing'].split(', ')
+        ]
+
+    res = client.get('/series/state?name=test-timing', headers={
+        'Accept-Encoding': 'gzip'
+    })
+    assert phases(res) == [
+        'parse', 'metadata', 'get', 'json', 'compress', 'total'
+    ]
+    assert all(
+        float(metric.split('dur=')[1]) >= 0
+        for metric in res.headers['Server-Timing'].split(', ')
+    )
+
+    res = client.get('/series/history?name=test-timing&format=tshpack')
+    assert phases(res) == [
+        'parse', 'metadata', 'get', 'compress', 'serialize', 'total'
+    ]
+
+    res = client.get('/series/staircase?name=test-timing&delta=P1D')
+    assert 'get' in phases(res)
+
+    # quiet, and slow log
+    quiet = webtest.TestApp(
+        app.make_app(
+            api.timeseries(str(engine.url), namespace='tsh'),
+            timings=False,
+            slowlog=0
+        )
+    )
+    with caplog.at_level('WARNING', logger='tshistory_rest'):
+        res = quiet.get('/series/state?name=test-timing')
+    assert 'Server-Timing' not in res.headers
+    [record] = caplog.records
+    assert record.getMessage().startswith(
+        'slow request GET /series/state?name=test-timing'
+    )
+    assert 'get=' in record.getMessage()
+
+
+def test_staircase_deltas(client):
+    # forecasts: each revision covers the next 48 hours
+    for rev in range(24):
+        idate = utcdt(2020, 1, 1) + pd.Timedelta(hours=rev)
+        series = genserie(idate, 'H', 48, [rev + .5])
+        res = client.patch('/series/state', params={
+            'name': 'test-staircase-deltas',
+            'series': util.tojson(series),
+            'author': 'Babar',
+            'insertion_date': idate,
+            'tzaware': util.tzaware_serie(series)
+        })
+        assert res.status_code in (200, 201)
+
+    deltas = ['PT1H', 'PT6H', 'P1D']
+    single = {
+        delta: client.get('/series/staircase', params={
+            'name': 'test-staircase-deltas',
+            'delta': delta
+        }).json
+        for delta in deltas
+    }
+    assert single['PT1H'] != single['PT6H']
+
+    res = client.get('/series/staircase', params=[
+        ('name', 'test-staircase-deltas'),
+        *(('delta', delta) for delta in deltas)
+    ])
+    assert res.json == {
+        pd.Timedelta(delta).isoformat(): single[delta]
+        for delta in deltas
+    }
+
+    res = client.get('/series/staircase', params=[
+        ('name', 'test-staircase-deltas'),
+        ('from_value_date', utcdt(2020, 1, 2)),
+        ('to_value_date', utcdt(2020, 1, 2, 12)),
+        ('format', 'tshpack'),
+        *(('delta', delta) for delta in deltas)
+    ])
+    header, entries = rutil.binary_unpack_many(res.body)
+    assert header == {'name': 'test-staircase-deltas'}
+    for (entry, series), delta in zip(entries, deltas):
+        assert entry['delta'] == pd.Timedelta(delta).isoformat()
+        assert entry['meta']['tzaware']
+        assert series.equals(
+            util.fromjson(
+                json.dumps(client.get('/series/staircase', params={
+                    'name': 'test-staircase-deltas',
+                    'from_value_date': utcdt(2020, 1, 2),
+                    'to_value_date': utcdt(2020, 1, 2, 12),
+                    'delta': delta
+                }).json),
+                'test-staircase-deltas',
+                tzaware=True
+            )
+        )
+
+    res = client.get('/series/staircase', params=[
+        ('name', 'test-staircase-deltas'),
+        ('delta', 'PT1H'),
+        ('delta', 'PT2H'),
+        ('format', 'arrow')
+    ], status=400)
+
+
+def test_changes(client):
+    series = genserie(utcdt(2020, 1, 1), 'D', 5, [1.5])
+    res = client.patch('/series/state', params={
+        'name': 'test-changes',
+        'series': util.tojson(series),
+        'author': 'Babar',
+        'insertion_date': utcdt(2021, 1, 1),
+        'tzaware': util.tzaware_serie(series)
+    })
+    assert res.status_code == 201
+
+    res = client.get('/series/changes?name=test-changes')
+    assert res.json == {
+        'name': 'test-changes',
+        'since': None,
+        'last_insertion_date': '2021-01-01T00:00:00+00:00',
+        'changes': {
+            '2020-01-01T00:00:00.000Z': 1.5,
+            '2020-01-02T00:00:00.000Z': 1.5,
+            '2020-01-03T00:00:00.000Z': 1.5,
+            '2020-01-04T00:00:00.000Z': 1.5,
+            '2020-01-05T00:00:00.000Z': 1.5
+        }
+    }
+    since = res.json['last_insertion_date']
+
+    # nothing new
+    res = client.get('/series/changes', params={
+        'name': 'test-changes',
+        'since': since
+    })
+    assert res.json['changes'] == {}
+    assert res.json['last_insertion_date'] == since
+
+    # two revisions: a change, a new point, an erased point, then
+    # another change of the same point
+    for idate, values in (
+            (utcdt(2021, 1, 2), [1.5, 2.5, 1.5, None, 1.5, 3.5]),
+            (utcdt(2021, 1, 3), [1.5, 4.5, 1.5, None, 1.5, 3.5])):
+        series = pd.Series(
+            values,
+            index=pd.date_range(utcdt(2020, 1, 1), freq='D', periods=6)
+        )
+        res = client.patch('/series/state', params={
+            'name': 'test-changes',
+            'series': util.tojson(series),
+            'author': 'Babar',
+            'insertion_date': idate,
+            'tzaware': util.tzaware_serie(series),
+            'replace': True
+        })
+        assert res.status_code == 200
+
+    res = client.get('/series/changes', params={
+        'name': 'test-changes',
+        'since': since
+    })
+    assert res.json == {
+        'name': 'test-changes',
+        'since': '2021-01-01T00:00:00+00:00',
+        'last_insertion_date': '2021-01-03T00:00:00+00:00',
+        'changes': {
+            '2020-01-02T00:00:00.000Z': 4.5,
+            '2020-01-04T00:00:00.000Z': None,
+            '2020-01-06T00:00:00.000Z': 3.5
+        }
+    }
+
+    res = client.get('/series/changes', params={
+        'name': 'test-changes',
+        'since': utcdt(2021, 1, 2),
+        'format': 'tshpack'
+    })
+    header, [(entry, changes)] = rutil.binary_unpack_many(res.body)
+    assert header['last_insertion_date'] == '2021-01-03T00:00:00+00:00'
+    assert entry['meta']['tzaware']
+    assert_df("""
+2020-01-02 00:00:00+00:00    4.5
+""", changes)
+
+    # the replica catches up
+    res = client.get('/series/state?name=test-changes')
+    replica = series.copy()
+    replica.loc[changes.index] = changes
+    assert util.fromjson(
+        json.dumps(res.json), 'test-changes', tzaware=True
+    ).equals(replica.dropna())
+
+    # a new point, then a replace erasing the first one
+    series = genserie(utcdt(2020, 1, 7), 'D', 1, [5.5])
+    res = client.patch('/series/state', params={
+        'name': 'test-changes',
+        'series': util.tojson(series),
+        'author': 'Babar',
+        'insertion_date': utcdt(2021, 1, 4),
+        'tzaware': util.tzaware_serie(series)
+    })
+    assert res.status_code == 200
+    res = client.get('/series/changes', params={
+        'name': 'test-changes',
+        'since': utcdt(2021, 1, 3)
+    })
+    assert res.json['changes'] == {
+        '2020-01-07T00:00:00.000Z': 5.5
+    }
+
+    series = pd.Series(
+        [4.5, 1.5, 1.5, 3.5, 5.5],
+        index=pd.DatetimeIndex([
+            utcdt(2020, 1, 2), utcdt(2020, 1, 3), utcdt(2020, 1, 5),
+            utcdt(2020, 1, 6), utcdt(2020, 1, 7)
+        ])
+    )
+    res = client.patch('/series/state', params={
+        'name': 'test-changes',
+        'series': util.tojson(series),
+        'author': 'Babar',
+        'insertion_date': utcdt(2021, 1, 5),
+        'tzaware': util.tzaware_serie(series),
+        'replace': True
+    })
+    assert res.status_code == 200
+    res = client.get('/series/changes', params={
+        'name': 'test-changes',
+        'since': utcdt(2021, 1, 4)
+    })
+    assert res.json['changes'] == {
+        '2020-01-01T00:00:00.000Z': None
+    }
+
+    res = client.get('/series/changes?name=no-such-series', status=404)
+    assert res.status_code == 404
+
+    if not has_formula():
+        return
+
+    res = client.patch('/series/formula', params={
+        'name': 'test-changes-formula',
+        'text': '(+ 1 (series "test-changes"))'
+    })
+    assert res.status_code == 201
+    res = client.get('/series/changes', params={
+        'name': 'test-changes-formula',
+        'since': utcdt(2021, 1, 2)
+    })
+    assert res.json == {
+        'name': 'test-changes-formula',
+        'since': '2021-01-02T00:00:00+00:00',
+        'last_insertion_date': '2021-01-05T00:00:00+00:00',
+        'changes': {
+            '2020-01-01T00:00:00.000Z': None,
+            '2020-01-02T00:00:00.000Z': 5.5,
+            '2020-01-07T00:00:00.000Z': 6.5
+        }
+    }
+    res = client.get('/series/changes?name=test-changes-formula')
+    assert res.json['last_insertion_date'] == '2021-01-05T00:00:00+00:00'
+    assert len(res.json['changes']) == 5
+
+    # a naive date is an utc one
+    for name in ('test-changes', 'test-changes-formula'):
+        res = client.get('/series/changes', params={
+            'name': name,
+            'since': '2021-01-02'
+        })
+        assert res.status_code == 200
+        assert res.json['since'] == '2021-01-02T00:00:00+00:00'
+        assert len(res.json['changes']) == 3
+
+
+def test_value_date_pages(client):
+    series = genserie(utcdt(2020, 1, 1), 'H', 24 * 5, [1.5])
+    for idate in (utcdt(2021, 1, 1), utcdt(2021, 1, 2)):
+        res = client.patch('/series/state', params={
+            'name': 'test-pages',
+            'series': util.tojson(series),
+            'author': 'Babar',
+            'insertion_date': idate,
+            'tzaware': util.tzaware_serie(series)
+        })
+        assert res.status_code in (200, 201)
+        series = genserie(utcdt(2020, 1, 6), 'H', 24, [2.5])
+
+    def walk(route, **params):
+        pages = []
+        cursor = None
+        while True:
+            res = client.get(route, params={
+                'name': 'test-pages',
+                'page_size': 'P2D',
+                'format': 'tshpack',
+                **params,
+                **({'cursor': cursor} if cursor else {})
+            })
+            assert res.status_code == 200
+            pages.append(res.body)
+            cursor = res.headers.get('X-Next-Cursor')
+            if cursor is None:
+                return pages
+
+    pages = [
+        rutil.binary_unpack_meta_data(page)[1]
+        for page in walk('/series/state')
+    ]
+    assert [len(page) for page in pages] == [48, 48, 48]
+    assert pd.concat(pages).index.is_unique
+    assert len(pd.concat(pages)) == 24 * 6
+    assert pages[0].index[0] == utcdt(2020, 1, 1)
+    assert pages[-1].index[-1] == utcdt(2020, 1, 6, 23)
+
+    # explicit bounds
+    pages = [
+        rutil.binary_unpack_meta_data(page)[1]
+        for page in walk(
+            '/series/state',
+            from_value_date=utcdt(2020, 1, 4),
+            to_value_date=utcdt(2020, 1, 6, 12)
+        )
+    ]
+    assert [len(page) for page in pages] == [48, 13]
+
+    pages = [
+        util.unpack_history(page)[1]
+        for page in walk('/series/history')
+    ]
+    assert [
+        [len(ts) for ts in hist.values()]
+        for hist in pages
+    ] == [[48], [48], [24, 48]]
+
+    res = client.get('/series/state', params={
+        'name': 'test-pages',
+        'page_size': 'P1D',
+        'cursor': 'not-a-cursor'
+    }, status=400)
+    res = client.get('/series/state', params={
+        'name': 'test-pages',
+        'page_size': 'P1D',
+        'cursor': rutil.encode_cursor({'not': 'a date'})
+    }, status=400)
+    res = client.get('/series/state', params={
+        'name': 'test-pages',
+        'page_size': '-P1D'
+    }, status=400)
+    res = client.get('/series/state', params={
+        'name': 'no-such-series',
+        'page_size': 'P1D'
+    }, status=404)
+
+    # naive series have naive pages
+    series = genserie(datetime(2020, 1, 1), 'H', 24 * 3, [1.5])
+    res = client.patch('/series/state', params={
+        'name': 'test-naive-pages',
+        'series': util.tojson(series),
+        'author': 'Babar',
+        'insertion_date': utcdt(2021, 1, 1),
+        'tzaware': util.tzaware_serie(series)
+    })
+    assert res.status_code == 201
+    with warnings.catch_warnings(record=True) as caught:
+        warnings.simplefilter('always')
+        pages = [
+            rutil.binary_unpack_meta_data(page)[1]
+            for page in walk(
+                '/series/state',
+                name='test-naive-pages',
+                from_value_date='2020-01-01T12:00:00+00:00'
+            )
+        ]
+    assert not [
+        warning for warning in caught
+        if issubclass(warning.category, FutureWarning)
+    ]
+    assert [len(page) for page in pages] == [48, 12]
+    assert pages[0].index[0] == pd.Timestamp('2020-01-01 12:00')
+
+
+def test_coalesced_reads(client, engine):
+    series = genserie(utcdt(2020, 1, 1), 'H', 24)
+    res = client.patch('/series/state', params={
+        'name': 'test-coalesce',
+        'series': util.tojson(series),
+        'author': 'Babar',
+        'insertion_date': utcdt(2020, 1, 1),
+        'tzaware': util.tzaware_serie(series)
+    })
+    assert res.status_code == 201
+
+    def herd(coalesce, readers=8):
+        calls = []
+        joined = []
+        release = threading.Event()
+
+        class slowtsh(tsio.timeseries):
+
+            def get(self, cn, name, **kw):
+                calls.append(name)
+                release.wait(10)
+                return super().get(cn, name, **kw)
+
+        class countedflight(singleflight):
+
+            def wait(self, current):
+                joined.append(current)
+                return super().wait(current)
+
+        tsa = api.timeseries(
+            str(engine.url), namespace='tsh', handler=slowtsh
+        )
+        with patch('tshistory_rest.blueprint.singleflight', countedflight):
+            wsgi = app.make_app(tsa, coalesce=coalesce)
+        bodies = []
+
+        def read():
+            client = wsgi.test_client()
+            res = client.get('/series/state?name=test-coalesce')
+            assert res.status_code == 200
+            bodies.append(res.data)
+
+        threads = [threading.Thread(target=read) for _ in range(readers)]
+        for th in threads:
+            th.start()
+        if coalesce:
+            # hold the first read until all the others wait for it
+            deadline = time.time() + 10
+            while len(joined) < readers - 1 and time.time() < deadline:
+                time.sleep(.01)
+        release.set()
+        for th in threads:
+            th.join()
+        assert len(bodies) == readers
+        assert len(set(bodies)) == 1
+        return len(calls)
+
+    assert herd(coalesce=True) == 1
+    assert herd(coalesce=False) == 8
+
+    # the waiters give up on a stuck read
+    flights = singleflight(timeout=.1)
+    stuck = threading.Event()
+    leader = threading.Thread(
+        target=flights.do, args=('key', lambda: stuck.wait(10))
+    )
+    leader.start()
+    while 'key' not in flights.flights:
+        time.sleep(.01)
+    assert flights.do('key', lambda: 42) == (42, False)
+    stuck.set()
+    leader.join()
+
+
+def test_resample(client):
+    # five minutes points, over two days
+    series = pd.Series(
+        [float(i % 12) for i in range(12 * 48)],
+        index=pd.date_range(utcdt(2020, 1, 1), freq='5min', periods=12 * 48)
+    )
+    res = client.patch('/series/state', params={
+        'name': 'test-resample',
+        'series': util.tojson(series),
+        'author': 'Babar',
+        'insertion_date': utcdt(2020, 1, 1),
+        'tzaware': util.tzaware_serie(series)
+    })
+    assert res.status_code == 201
+
+    res = client.get('/series/state', params={
+        'name': 'test-resample',
+        'resample': '1H'
+    })
+    assert len(res.json) == 48
+    assert set(res.json.values()) == {5.5}
+
+    for how, value in (('sum', 66.), ('min', 0.), ('max', 11.), ('last', 11.)):
+        res = client.get('/series/state', params={
+            'name': 'test-resample',
+            'resample': '1D',
+            'how': how,
+            'format': 'tshpack'
+        })
+        _meta, daily = rutil.binary_unpack_meta_data(res.body)
+        assert len(daily) == 2
+        assert daily.iloc[0] == value * (24 if how == 'sum' else 1)
+
+    # a gap makes no period
+    res = client.get('/series/state', params={
+        'name': 'test-resample',
+        'from_value_date': utcdt(2020, 1, 1),
+        'to_value_date': utcdt(2020, 1, 1, 2, 55),
+        'resample': '1H',
+        'how': 'sum'
+    })
+    assert res.json == {
+        '2020-01-01T00:00:00.000Z': 66.0,
+        '2020-01-01T01:00:00.000Z': 66.0,
+        '2020-01-01T02:00:00.000Z': 66.0
+    }
+
+    series = series[-12:] + 1.5
+    res = client.patch('/series/state', params={
+        'name': 'test-resample',
+        'series': util.tojson(series),
+        'author': 'Babar',
+        'insertion_date': utcdt(2020, 1, 2),
+        'tzaware': util.tzaware_serie(series)
+    })
+    res = client.get('/series/history', params={
+        'name': 'test-resample',
+        'resample': '1D',
+        'how': 'max',
+        'format': 'tshpack'
+    })
+    _meta, hist = util.unpack_history(res.body)
+    assert [ts.tolist() for ts in hist.values()] == [[11., 11.], [11., 12.5]]
+
+    res = client.get('/series/history', params={
+        'name': 'test-resample',
+        'resample': '1D',
+        'how': 'max',
+        'stream': True
+    })
+    assert [
+        list(json.loads(line).values())[0]
+        for line in res.text.splitlines()
+    ] == [
+        {'2020-01-01T00:00:00.000Z': 11.0, '2020-01-02T00:00:00.000Z': 11.0},
+        {'2020-01-01T00:00:00.000Z': 11.0, '2020-01-02T00:00:00.000Z': 12.5}
+    ]
+
+    res = client.get('/series/staircase', params={
+        'name': 'test-resample',
+        'delta': 'PT1H',
+        'resample': '1D',
+        'how': 'last'
+    })
+    assert list(res.json.values()) == [11.0, 12.5]
+
+    res = client.get('/series/state', params={
+        'name': 'test-resample',
+        'resample': 'not-a-rule'
+    }, status=400)
+    assert res.status_code == 400
+
+
+def test_resample_pages(client):
+    # hourly points from noon: the pages must not split the days
+    series = genserie(utcdt(2020, 1, 1, 12), 'H', 72, [1.5])
+    res = client.patch('/series/state', params={
+        'name': 'test-resample-pages',
+        'series': util.tojson(series),
+        'author': 'Babar',
+        'insertion_date': utcdt(2021, 1, 1),
+        'tzaware': util.tzaware_serie(series)
+    })
+    assert res.status_code == 201
+
+    pages = []
+    cursor = None
+    while True:
+        res = client.get('/series/state', params={
+            'name': 'test-resample-pages',
+            'page_size': 'P1D',
+            'resample': '1D',
+            'how': 'sum',
+            **({'cursor': cursor} if cursor else {})
+        })
+        assert res.status_code == 200
+        pages.append(res.json)
+        cursor = res.headers.get('X-Next-Cursor')
+        if cursor is None:
+            break
+    assert pages == [
+        {'2020-01-01T00:00:00.000Z': 18.0},
+        {'2020-01-02T00:00:00.000Z': 36.0},
+        {'2020-01-03T00:00:00.000Z': 36.0},
+        {'2020-01-04T00:00:00.000Z': 18.0}
+    ]
+
+    # periods which would straddle the pages
+    for page_size, rule in (('PT12H', '1D'), ('P1D', '7D'), ('P31D', 'MS')):
+        res = client.get('/series/state', params={
+            'name': 'test-resample-pages',
+            'page_size': page_size,
+            'resample': rule
+        }, status=400)
+        assert res.json == {
+            'message': 'the page size must be a whole number of periods, '
+            'of a day at most'
+        }
+
+
+def test_insertion_dates(client):
+    series = genserie(utcdt(2020, 1, 1), 'D', 3, [1.5])
+    for day in range(1, 6):
+        series = series + 1
+        res = client.patch('/series/state', params={
+            'name': 'test-idates',
+            'series': util.tojson(series),
+            'author': 'Babar',
+            'insertion_date': utcdt(2021, 1, day),
+            'tzaware': util.tzaware_serie(series)
+        })
+        assert res.status_code in (200, 201)
+
+    res = client.get('/series/insertion_dates?name=test-idates')
+    assert res.json == [
+        f'2021-01-0{day}T00:00:00+00:00'
+        for day in range(1, 6)
+    ]
+
+    res = client.get('/series/insertion_dates', params={
+        'name': 'test-idates',
+        'from_insertion_date': utcdt(2021, 1, 2),
+        'to_insertion_date': utcdt(2021, 1, 4)
+    })
+    assert res.json == [
+        '2021-01-02T00:00:00+00:00',
+        '2021-01-03T00:00:00+00:00',
+        '2021-01-04T00:00:00+00:00'
+    ]
+
+    res = client.get('/series/insertion_dates', params={
+        'name': 'test-idates',
+        'from_insertion_date': utcdt(2021, 1, 2),
+        'limit': 2,
+        'format': 'tshpack'
+    })
+    assert rutil.unpack_insertion_dates(res.body) == [
+        utcdt(2021, 1, 2), utcdt(2021, 1, 3)
+    ]
+
+    res = client.get('/series/insertion_dates?name=no-such-series', status=404)
+    assert res.status_code == 404
+
+    if not has_formula():
+        return
+
+    res = client.patch('/series/formula', params={
+        'name': 'test-idates-formula',
+        'text': '(+ 1 (series "test-idates"))'
+    })
+    assert res.status_code == 201
+    res = client.get('/series/insertion_dates?name=test-idates-formula')
+    assert res.json == [
+        f'2021-01-0{day}T00:00:00+00:00'
+        for day in range(1, 6)
+    ]
+    res = client.get('/series/insertion_dates', params={
+        'name': 'test-idates-formula',
+        'from_insertion_date': utcdt(2021, 1, 2),
+        'limit': 2,
+        'format': 'tshpack'
+    })
+    assert rutil.unpack_insertion_dates(res.body) == [
+        utcdt(2021, 1, 2), utcdt(2021, 1, 3)
+    ]
+
+
+@pytest.mark.skipif(
+    not has_formula(),
+    reason='need formula plugin to be available'
+)
+def test_formula_cache(cacheclient, engine):
+    client = cacheclient
+    for name, values in (('fcache-a', [1.5]), ('fcache-b', [10.5])):
+        series = genserie(utcdt(2020, 1, 1), 'D', 3, values)
+        res = client.patch('/series/state', params={
+            'name': name,
+            'series': util.tojson(series),
+            'author': 'Babar',
+            'insertion_date': utcdt(2020, 1, 1),
+            'tzaware': util.tzaware_serie(series)
+        })
+        assert res.status_code == 201
+
+    for name, text in (
+            ('fcache-sum', '(add (series "fcache-a") (series "fcache-b"))'),
+            ('fcache-nested', '(+ 1 (series "fcache-sum"))')):
+        res = client.patch('/series/formula', params={
+            'name': name,
+            'text': text
+        })
+        assert res.status_code == 201
+
+    def read(name):
+        return list(client.get(f'/series/state?name={name}').json.values())
+
+    stats = client.get('/series/cache').json
+    assert read('fcache-sum') == [12., 12., 12.]
+    assert read('fcache-nested') == [13., 13., 13.]
+    assert read('fcache-sum') == [12., 12., 12.]
+    assert read('fcache-nested') == [13., 13., 13.]
+    after = client.get('/series/cache').json
+    assert after['hits'] - stats['hits'] == 2
+    assert after['entries'] - stats['entries'] == 2
+
+    # an operand write drops the formulas reading it
+    series = genserie(utcdt(2020, 1, 4), 'D', 1, [2.5])
+    res = client.patch('/series/state', params={
+        'name': 'fcache-b',
+        'series': util.tojson(series),
+        'author': 'Babar',
+        'insertion_date': utcdt(2020, 1, 2),
+        'tzaware': util.tzaware_serie(series)
+    })
+    assert res.status_code == 200
+    assert client.get('/series/cache').json['entries'] == stats['entries']
+    assert read('fcache-sum') == [12., 12., 12.]
+    assert read('fcache-nested') == [13., 13., 13.]
+
+    # as does an operand formula update
+    res = client.patch('/series/formula', params={
+        'name': 'fcache-sum',
+        'text': '(add (series "fcache-a") (series "fcache-b") (series "fcache-a"))',
+        'force_update': True
+    })
+    assert res.status_code == 200
+    assert read('fcache-nested') == [14.5, 14.5, 14.5]
+
+    # the writes to the secondary sources are not seen: no caching
+    series = genserie(utcdt(2020, 1, 1), 'D', 3, [.5])
+    tsio.timeseries('other').update(
+        engine, series, 'fcache-remote', 'Babar'
+    )
+    res = client.patch('/series/formula', params={
+        'name': 'fcache-mixed',
+        'text': '(add (series "fcache-a") (series "fcache-remote"))'
+    })
+    assert res.status_code == 201
+    stats = client.get('/series/cache').json
+    assert read('fcache-mixed') == [2., 2., 2.]
+    assert client.get('/series/cache').json['entries'] == stats['entries']
+    series = genserie(utcdt(2020, 1, 1), 'D', 3, [1.5])
+    tsio.timeseries('other').update(
+        engine, series, 'fcache-remote', 'Babar'
+    )
+    assert read('fcache-mixed') == [3., 3., 3.]
+
+
+@pytest.mark.skipif(
+    not has_formula(),
+    reason='need formula plugin to be available'
+)
+def test_formula_prefetch(client, engine):
+    from tshistory_formula.tsio import timeseries
+
+    for idx in range(6):
+        series = genserie(utcdt(2020, 1, 1), 'D', 3, [idx + .5])
+        res = client.patch('/series/state', params={
+            'name': f'prefetch-{idx}',
+            'series': util.tojson(series),
+            'author': 'Babar',
+            'insertion_date': utcdt(2020, 1, 1),
+            'tzaware': util.tzaware_serie(series)
+        })
+        assert res.status_code == 201
+
+    for name, text in (
+            ('prefetch-nested',
+             '(add (series "prefetch-3") (series "prefetch-4") '
+             '(series "prefetch-5"))'),
+            ('prefetch-formula',
+             '(add (series "prefetch-0") (series "prefetch-1") '
+             '(series "prefetch-2") (series "prefetch-nested") '
+             '(series "prefetch-0")))')):
+        res = client.patch('/series/formula', params={
+            'name': name,
+            'text': text
+        })
+        assert res.status_code == 201
+
+    def read(**options):
+        reads = []
+        running = []
+        lock = threading.Lock()
+
+        class slowtsh(timeseries):
+
+            def metadata(self, cn, name):
+                # the operand reads need theirs
+                worker = threading.current_thread().name.startswith(
+                    'tshistory-rest-prefetch'
+                )
+                if name != 'prefetch-formula' and not worker:
+                    lookups.append(name)
+                return super().metadata(cn, name)
+
+            def get(self, cn, name, **kw):
+                if not name.startswith('prefetch-') or \
+                   self.type(cn, name) == 'formula':
+                    return super().get(cn, name, **kw)
+                with lock:
+                    reads.append(name)
+                    running.append(name)
+                    peak.append(len(running))
+                time.sleep(.1)
+                try:
+                    return super().get(cn, name, **kw)
+                finally:
+                    with lock:
+                        running.remove(name)
+
+        peak = []
+        lookups = []
+        tsa = api.timeseries(
+            str(engine.url), namespace='tsh', handler=slowtsh
+        )
+        wsgi = app.make_app(tsa, **options).test_client()
+        res = wsgi.get('/series/state', query_string={
+            'name': 'prefetch-formula',
+            'from_value_date': str(utcdt(2020, 1, 2)),
+            'to_value_date': str(utcdt(2020, 1, 3))
+        })
+        assert res.status_code == 200
+        return res, sorted(reads), max(peak), lookups
+
+    # the operands share the request connection
+    sequential, reads, _peak, _lookups = read()
+    assert json.loads(sequential.data) == {
+        '2020-01-02T00:00:00.000Z': 18.5,
+        '2020-01-03T00:00:00.000Z': 18.5
+    }
+    assert len(reads) == 7
+
+    # each operand with its own connection, three at once
+    prefetched, reads, peak, lookups = read(prefetch=8, prefetch_limit=3)
+    assert prefetched.data == sequential.data
+    assert reads == [f'prefetch-{idx}' for idx in range(6)]
+    assert peak == 3
+    assert 'prefetch;dur=' in prefetched.headers['Server-Timing']
+    # the operands are found without a lookup per operand
+    assert lookups == []
+
+
+def test_slow_source(engine):
+    slow = threading.Event()
+    slow.set()
+
+    class slowtsh(tsio.timeseries):
+
+        def wait(self):
+            if self.namespace == 'other' and slow.is_set():
+                time.sleep(1)
+
+        def exists(self, cn, name):
+            self.wait()
+            return super().exists(cn, name)
+
+        def list_series(self, cn):
+            self.wait()
+            return super().list_series(cn)
+
+    tsa = api.timeseries(
+        str(engine.url),
+        namespace='tsh',
+        handler=slowtsh,
+        sources=[(str(engine.url), 'other')]
+    )
+    client = webtest.TestApp(
+        app.make_app(tsa, catalog_ttl=600, source_timeout=.2)
+    )
+    other = 'db://localhost:5433/postgres!other'
+
+    res = client.get('/series/catalog', params={'allsources': True})
+    assert res.headers['X-Source-Status'] == f'{other}=timeout'
+    assert other not in res.json
+    assert 'db://localhost:5433/postgres!tsh' in res.json
+
+    # local series: the sources are not asked
+    res = client.get('/series/state', params={'name': 'test-multi'})
+    assert 'X-Source-Status' not in res.headers
+
+    res = client.get(
+        '/series/state', params={'name': 'test-other-source'},
+        status=504
+    )
+    assert res.headers['X-Source-Status'] == f'{other}=timeout'
+    assert res.json['message'] == (
+        f'`test-other-source`: no answer from the sources {other}'
+    )
+
+    slow.clear()
+    res = client.get('/series/state', params={'name': 'test-other-source'})
+    assert res.headers['X-Source-Status'] == f'{other}=ok'
+    assert len(res.json) == 3
+    client.get(
+        '/series/state', params={'name': 'no-such-series'},
+        status=404
+    )
+
+    # the partial catalog was not kept
+    res = client.get('/series/catalog', params={'allsources': True})
+    assert res.headers['X-Source-Status'] == f'{other}=ok'
+    assert other in res.json
+    res = client.get('/series/catalog', params={'allsources': True})
+    assert 'X-Source-Status' not in res.headers
+    assert other in res.json
+
+
+def test_slow_first_source(engine):
+    # the series is held by the second source, behind a slow one
+
+    class slowtsh(tsio.timeseries):
+
+        def exists(self, cn, name):
+            if self.namespace == 'slow':
+                time.sleep(1)
+            return super().exists(cn, name)
+
+    tsa = api.timeseries(
+        str(engine.url),
+        namespace='tsh',
+        handler=slowtsh,
+        sources=[
+            (str(engine.url), 'slow'),
+            (str(engine.url), 'other')
+        ]
+    )
+    client = webtest.TestApp(
+        app.make_app(tsa, source_timeout=.2, source_workers=16)
+    )
+    slow = 'db://localhost:5433/postgres!slow'
+    other = 'db://localhost:5433/postgres!other'
+
+    for route, params in (
+            ('state', {}),
+            ('history', {}),
+            ('history', {'stream': True}),
+            ('staircase', {'delta': pd.Timedelta(hours=1)}),
+            ('metadata', {'type': 'interval'}),
+            ('insertion_dates', {})):
+        start = time.time()
+        res = client.get(f'/series/{route}', params={
+            'name': 'test-other-source',
+            **params
+        })
+        assert time.time() - start < .9, route
+        assert res.status_code == 200
+        assert res.headers['X-Source-Status'] == (
+            f'{slow}=timeout, {other}=ok'
+        )
+
+    # unknown names do not fail the whole bulk read
+    start = time.time()
+    res = client.get('/series/bulk', params={
+        'name': ['test-multi', 'test-other-source', 'no-such-series']
+    })
+    assert time.time() - start < 1.8
+    assert list(res.json['series']) == ['test-multi', 'test-other-source']
+    assert res.json['missing'] == []
+    assert res.json['unavailable'] == ['no-such-series']
+
+    res = client.get('/series/bulk', params={
+        'name': ['no-such-series'],
+        'format': 'tshpack'
+    })
+    header, entries = rutil.binary_unpack_many(res.body)
+    assert header == {'missing': [], 'unavailable': ['no-such-series']}
+    assert entries == []
+
+
+def test_stuck_source(engine):
+    # a source whose lookups hang does not starve the other one
+    stuck = threading.Event()
+
+    class stucktsh(tsio.timeseries):
+
+        def exists(self, cn, name):
+            if self.namespace == 'slow':
+                stuck.wait(10)
+            return super().exists(cn, name)
+
+    tsa = api.timeseries(
+        str(engine.url),
+        namespace='tsh',
+        handler=stucktsh,
+        sources=[
+            (str(engine.url), 'slow'),
+            (str(engine.url), 'other')
+        ]
+    )
+    client = webtest.TestApp(
+        app.make_app(tsa, source_timeout=.1, source_workers=2)
+    )
+    slow = 'db://localhost:5433/postgres!slow'
+    other = 'db://localhost:5433/postgres!other'
+
+    statuses = []
+    for _ in range(4):
+        res = client.get('/series/state', params={
+            'name': 'test-other-source'
+        })
+        assert res.status_code == 200
+        statuses.append(res.headers['X-Source-Status'])
+    assert statuses == [
+        f'{slow}=timeout, {other}=ok',
+        f'{slow}=timeout, {other}=ok',
+        f'{slow}=busy, {other}=ok',
+        f'{slow}=busy, {other}=ok'
+    ]
+
+    # its threads are back once it answers
+    stuck.set()
+    deadline = time.time() + 5
+    while time.time() < deadline:
+        res = client.get('/series/state', params={
+            'name': 'test-other-source'
+        })
+        if res.headers['X-Source-Status'] == f'{slow}=ok, {other}=ok':
+            break
+        time.sleep(.05)
+    assert res.headers['X-Source-Status'] == f'{slow}=ok, {other}=ok'
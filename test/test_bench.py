@@ -0,0 +1,215 @@
+"""Benchmarks of the series read routes
+
+They only run with `pytest --bench` and sweep the series length
+(state) and the revision count (history, staircase) in the json and
+tshpack formats (and the history in the columnar json).
+
+    pytest --bench test/test_bench.py --bench-output bench.json
+    pytest --bench test/test_bench.py --bench-baseline bench.json
+
+`--bench-quick` restricts the sweeps to the small sizes.
+"""
+import json
+from pathlib import Path
+import statistics
+from time import perf_counter
+import tracemalloc
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from tshistory import api
+from tshistory.testutil import utcdt
+
+
+SIZES = (100, 1000, 10_000, 100_000, 1_000_000)
+REVISIONS = (1, 10, 100, 1000, 5000)
+QUICK_SIZES = 10_000
+QUICK_REVISIONS = 100
+FORMATS = ('json', 'tshpack')
+# the history also compares the dense json to the columnar one
+HISTORY_FORMATS = FORMATS + ('columnar',)
+# points per revision of the forecast-like histories
+HORIZON = 48
+
+
+def measure(func, repeat=5):
+    """run `func` to get its python memory peak, then `repeat` times
+    to get its latencies
+
+    """
+    tracemalloc.start()
+    try:
+        func()
+        _size, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    latencies = []
+    for _ in range(repeat):
+        t0 = perf_counter()
+        result = func()
+        latencies.append(perf_counter() - t0)
+    return latencies, peak, result
+
+
+class benchrecorder:
+    " collect the results, compare them with the baseline "
+
+    def __init__(self, config):
+        self.output = config.getoption('--bench-output')
+        self.tolerance = config.getoption('--bench-tolerance')
+        self.quick = config.getoption('--bench-quick')
+        self.results = []
+        self.baseline = {}
+        path = config.getoption('--bench-baseline')
+        if path:
+            self.baseline = {
+                result['key']: result
+                for result in json.loads(Path(path).read_text())['results']
+            }
+
+    def record(self, key, **measures):
+        result = dict(key=key, **measures)
+        self.results.append(result)
+        print(
+            f'{key:<40} {result["latency_ms"]:10.1f} ms '
+            f'{result["throughput"]:14.0f} pts/s '
+            f'{result["bytes"]:>12} bytes '
+            f'{result["peak_memory"]:>12} peak'
+        )
+        base = self.baseline.get(key)
+        if base is None:
+            return
+        regressions = [
+            f'{measure}: {base[measure]} -> {result[measure]}'
+            for measure in ('latency_ms', 'peak_memory')
+            if result[measure] > base[measure] * (1 + self.tolerance)
+        ]
+        if regressions:
+            pytest.fail(f'{key} regressed: ' + ', '.join(regressions))
+
+    def finish(self):
+        if not self.output:
+            return
+        Path(self.output).write_text(
+            json.dumps({
+                'pandas': pd.__version__,
+                'results': self.results
+            }, indent=2)
+        )
+
+
+@pytest.fixture(scope='module')
+def bench(request):
+    recorder = benchrecorder(request.config)
+    yield recorder
+    recorder.finish()
+
+
+@pytest.fixture(scope='module')
+def tsa(engine):
+    return api.timeseries(str(engine.url), namespace='tsh')
+
+
+def state_series(tsa, size):
+    name = f'bench-state-{size}'
+    if not tsa.exists(name):
+        values = np.random.default_rng(42).random(size)
+        tsa.update(
+            name,
+            pd.Series(
+                values,
+                index=pd.date_range(utcdt(2020, 1, 1), freq='T', periods=size)
+            ),
+            'Babar',
+            insertion_date=utcdt(2020, 1, 1)
+        )
+    return name
+
+
+def forecast_series(tsa, revisions):
+    # each revision covers a window shifted by one hour
+    name = f'bench-forecast-{revisions}'
+    if not tsa.exists(name):
+        rng = np.random.default_rng(42)
+        for rev in range(revisions):
+            start = utcdt(2020, 1, 1) + pd.Timedelta(hours=rev)
+            tsa.update(
+                name,
+                pd.Series(
+                    rng.random(HORIZON),
+                    index=pd.date_range(start, freq='H', periods=HORIZON)
+                ),
+                'Babar',
+                insertion_date=start
+            )
+    return name
+
+
+def run(bench, client, key, route, params, points, repeat=5):
+    latencies, peak, res = measure(
+        lambda: client.get(route, params=params),
+        repeat
+    )
+    assert res.status_code == 200
+    latency = statistics.median(latencies)
+    bench.record(
+        key,
+        route=route,
+        format=params['format'],
+        points=points,
+        latency_ms=round(latency * 1000, 3),
+        best_ms=round(min(latencies) * 1000, 3),
+        throughput=round(points / latency),
+        bytes=len(res.body),
+        peak_memory=peak
+    )
+
+
+@pytest.mark.bench
+@pytest.mark.parametrize('fmt', FORMATS)
+@pytest.mark.parametrize('size', SIZES)
+def test_bench_state(bench, client, tsa, size, fmt):
+    if bench.quick and size > QUICK_SIZES:
+        pytest.skip('quick mode')
+    name = state_series(tsa, size)
+    run(
+        bench, client, f'state:points={size}:{fmt}',
+        '/series/state', {'name': name, 'format': fmt},
+        size
+    )
+
+
+@pytest.mark.bench
+@pytest.mark.parametrize('fmt', HISTORY_FORMATS)
+@pytest.mark.parametrize('revisions', REVISIONS)
+def test_bench_history(bench, client, tsa, revisions, fmt):
+    if bench.quick and revisions > QUICK_REVISIONS:
+        pytest.skip('quick mode')
+    name = forecast_series(tsa, revisions)
+    # every revision holds the whole state up to its insertion date
+    points = sum(HORIZON + rev for rev in range(revisions))
+    run(
+        bench, client, f'history:revisions={revisions}:{fmt}',
+        '/series/history', {'name': name, 'format': fmt},
+        points,
+        repeat=3
+    )
+
+
+@pytest.mark.bench
+@pytest.mark.parametrize('fmt', FORMATS)
+@pytest.mark.parametrize('revisions', REVISIONS)
+def test_bench_staircase(bench, client, tsa, revisions, fmt):
+    if bench.quick and revisions > QUICK_REVISIONS:
+        pytest.skip('quick mode')
+    name = forecast_series(tsa, revisions)
+    delta = pd.Timedelta(hours=6)
+    run(
+        bench, client, f'staircase:revisions={revisions}:{fmt}',
+        '/series/staircase', {'name': name, 'delta': delta, 'format': fmt},
+        len(tsa.staircase(name, delta)),
+        repeat=3
+    )
+
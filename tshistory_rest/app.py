@@ -1,12 +1,37 @@
 from flask import Flask
 
 from tshistory_rest.blueprint import blueprint
+from tshistory_rest.metrics import install as instrument
 
 
-def make_app(tsa):
+def make_app(tsa, metrics=False, **options):
+    """the flask application serving the `blueprint` routes (see its
+    options), plus a prometheus /metrics route if `metrics` is true
+
+    """
     app = Flask(__name__)
     app.register_blueprint(
-        blueprint(tsa)
+        blueprint(tsa, **options)
     )
+    if metrics:
+        instrument(app)
     return app
 
+
+def make_asgi_app(tsa, workers=16, send_timeout=30, **options):
+    """an ASGI application serving the same routes as `make_app`,
+    where the blocking work runs on a pool of `workers` threads, the
+    clients slower than `send_timeout` seconds to take a response
+    chunk being dropped
+
+    The pool should not be larger than what the database connection
+    pool of `tsa` can serve.
+
+    It needs the a2wsgi package.
+    """
+    from tshistory_rest.asgi import asgiapp
+    return asgiapp(
+        make_app(tsa, **options),
+        workers=workers,
+        send_timeout=send_timeout
+    )
@@ -0,0 +1,51 @@
+import asyncio
+import logging
+
+from a2wsgi import WSGIMiddleware
+
+
+L = logging.getLogger('tshistory_rest')
+
+
+class asgiapp:
+    """An ASGI front for a WSGI application (through a2wsgi): each
+    request runs (and its response body is iterated) on a bounded
+    thread pool, so that the event loop keeps accepting requests
+    while blocking reads wait on the database.
+
+    The response body is sent as it is produced, the worker thread
+    waiting when the client lags more than `buffered` chunks behind.
+    A client not taking a chunk within `send_timeout` seconds is
+    dropped: the rest of its response is discarded, so that a slow
+    client cannot hold a worker thread for ever.
+    """
+    __slots__ = ('wsgi', 'send_timeout')
+
+    def __init__(self, wsgi, workers=16, buffered=8, send_timeout=30):
+        self.wsgi = WSGIMiddleware(
+            wsgi, workers=workers, send_queue_size=buffered
+        )
+        self.send_timeout = send_timeout
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] != 'http':
+            return await self.wsgi(scope, receive, send)
+
+        gone = False
+
+        async def timedsend(message):
+            nonlocal gone
+            if gone:
+                return
+            try:
+                await asyncio.wait_for(send(message), self.send_timeout)
+            except asyncio.TimeoutError:
+                # the server closes the connection of an unfinished
+                # response
+                gone = True
+                L.warning(
+                    'client %s too slow, dropping the response to %s',
+                    (scope.get('client') or ('?',))[0], scope['path']
+                )
+
+        await self.wsgi(scope, receive, timedsend)
@@ -1,10 +1,28 @@
+import bisect
+from collections import Counter
+from contextlib import contextmanager
+from copy import copy
+from fnmatch import fnmatchcase
+from functools import (
+    partial,
+    wraps
+)
+import hashlib
 import json
+import logging
+from time import perf_counter
+import zlib
 
+import numpy as np
 import pandas as pd
 
 from flask import (
     Blueprint,
-    make_response
+    g,
+    has_request_context,
+    make_response,
+    request,
+    Response
 )
 from flask_restx import (
     Api as baseapi,
@@ -14,12 +32,42 @@ from flask_restx import (
 )
 
 from tshistory import api as tsapi, util
+from tshistory.tsio import historycache
 
+from tshistory_rest.cache import (
+    lrucache,
+    singleflight
+)
+from tshistory_rest.sources import (
+    fanout,
+    sourcename
+)
 from tshistory_rest.util import (
+    AGGREGATIONS,
+    binary_pack_many,
     binary_pack_meta_data,
+    binary_unpack_many,
+    binary_unpack_meta_data,
+    columnar_history,
+    columnar_json,
+    decode_cursor,
+    encode,
+    encode_cursor,
+    encodings as available_encodings,
     enum,
+    ARROW_MIMETYPE,
+    arrow_history_chunks,
+    arrow_series,
+    frame,
+    has_arrow,
     has_formula,
+    offset,
+    pack_history,
+    pack_history_chunk,
+    pack_insertion_dates,
+    resample,
     todict,
+    UNPACK_ERRORS,
     utcdt
 )
 
@@ -31,6 +79,37 @@ def no_content():
     return resp
 
 
+def not_modified(etag, lastmodified):
+    resp = make_response('', 304)
+    resp.headers.clear()
+    return conditional(resp, etag, lastmodified)
+
+
+def conditional(response, etag, lastmodified):
+    if etag is not None:
+        # weak: the content encoding may vary
+        response.set_etag(etag, weak=True)
+        response.last_modified = lastmodified
+    return response
+
+
+def fresh(etag, lastmodified):
+    " tell if the client copy matches the validators "
+    if etag is None:
+        return False
+    if request.if_none_match:
+        return request.if_none_match.contains_weak(etag)
+    since = request.if_modified_since
+    # http dates have a one second resolution
+    return since is not None and lastmodified.floor('s') <= since
+
+
+# the read formats of the series, history and staircase routes
+formats = ('json', 'tshpack')
+if has_arrow():
+    formats += ('arrow',)
+
+
 base = reqparse.RequestParser()
 
 base.add_argument(
@@ -40,8 +119,9 @@ base.add_argument(
 
 update = base.copy()
 update.add_argument(
-    'series', type=str, required=True,
-    help='json representation of the series'
+    'series', type=str, default=None,
+    help='json representation of the series '
+    '(unless it comes as an application/octet-stream tshpack body)'
 )
 update.add_argument(
     'author', type=str, required=True,
@@ -100,7 +180,17 @@ get.add_argument(
     'to_value_date', type=utcdt, default=None
 )
 get.add_argument(
-    'format', type=enum('json', 'tshpack'), default='json'
+    'format', type=enum(*formats, 'columnar'), default='json',
+    help='columnar: json with epoch milliseconds index and values arrays'
+)
+get.add_argument(
+    'page_size', type=pd.Timedelta, default=None,
+    help='width of the value dates page, as an iso 8601 duration '
+    '(the X-Next-Cursor header holds the token of the next page)'
+)
+get.add_argument(
+    'cursor', type=str, default=None,
+    help='continuation token of the previous page'
 )
 
 delete = base.copy()
@@ -125,13 +215,31 @@ history.add_argument(
     '_keep_nans', type=inputs.boolean, default=False
 )
 history.add_argument(
-    'format', type=enum('json', 'tshpack'), default='json'
+    'format', type=enum(*formats, 'columnar'), default='json',
+    help='columnar: one json object per revision, with epoch milliseconds '
+    'index and values arrays, with no alignment of the revisions'
+)
+history.add_argument(
+    'stream', type=inputs.boolean, default=False,
+    help='send the revisions one by one as independent chunks '
+    '(json lines, length-prefixed tshpack frames or arrow record batches)'
+)
+
+history.add_argument(
+    'page_size', type=pd.Timedelta, default=None,
+    help='width of the value dates page, as an iso 8601 duration '
+    '(the X-Next-Cursor header holds the token of the next page)'
+)
+history.add_argument(
+    'cursor', type=str, default=None,
+    help='continuation token of the previous page'
 )
 
 staircase = base.copy()
 staircase.add_argument(
-    'delta', type=pd.Timedelta, required=True,
-    help='time delta in iso 8601 duration'
+    'delta', type=pd.Timedelta, action='append', required=True,
+    help='time delta in iso 8601 duration '
+    '(several deltas are computed from one history read)'
 )
 staircase.add_argument(
     'from_value_date', type=utcdt, default=None
@@ -140,13 +248,95 @@ staircase.add_argument(
     'to_value_date', type=utcdt, default=None
 )
 staircase.add_argument(
+    'format', type=enum(*formats, 'columnar'), default='json',
+    help='columnar: json with epoch milliseconds index and values arrays'
+)
+
+changes = base.copy()
+changes.add_argument(
+    'since', type=utcdt, default=None,
+    help='last insertion date seen by the client (exclusive)'
+)
+changes.add_argument(
+    'format', type=enum('json', 'tshpack'), default='json'
+)
+
+insertion_dates = base.copy()
+insertion_dates.add_argument(
+    'from_insertion_date', type=utcdt, default=None
+)
+insertion_dates.add_argument(
+    'to_insertion_date', type=utcdt, default=None
+)
+insertion_dates.add_argument(
+    'limit', type=inputs.positive, default=None,
+    help='maximum number of insertion dates, from the oldest'
+)
+insertion_dates.add_argument(
+    'format', type=enum('json', 'tshpack'), default='json',
+    help='tshpack: zlib compressed array of int64 utc nanoseconds'
+)
+
+for parser in (get, history, staircase):
+    parser.add_argument(
+        'resample', type=offset, default=None,
+        help='aggregate the values (of each revision for the history) '
+        'over periods given as a pandas offset alias, e.g. 1H or 1D'
+    )
+    parser.add_argument(
+        'how', type=enum(*AGGREGATIONS), default='mean',
+        help='aggregation of the resampled values'
+    )
+
+bulk_get = reqparse.RequestParser()
+bulk_get.add_argument(
+    'name', type=str, action='append', required=True,
+    help='timeseries names'
+)
+bulk_get.add_argument(
+    'insertion_date', type=utcdt, default=None,
+    help='insertion date can be forced'
+)
+bulk_get.add_argument(
+    'from_value_date', type=utcdt, default=None
+)
+bulk_get.add_argument(
+    'to_value_date', type=utcdt, default=None
+)
+bulk_get.add_argument(
     'format', type=enum('json', 'tshpack'), default='json'
 )
 
+bulk_update = reqparse.RequestParser()
+bulk_update.add_argument(
+    'author', type=str, required=True,
+    help='author of the insertions'
+)
+bulk_update.add_argument(
+    'insertion_date', type=utcdt, default=None,
+    help='insertion date can be forced'
+)
+
 catalog = reqparse.RequestParser()
 catalog.add_argument(
     'allsources', type=inputs.boolean, default=True
 )
+catalog.add_argument(
+    'pattern', type=str, default=None,
+    help='glob pattern the series names must match (e.g. `prefix*`)'
+)
+catalog.add_argument(
+    'kind', type=enum('primary', 'formula'), default=None,
+    help='only list the series of this kind'
+)
+catalog.add_argument(
+    'limit', type=inputs.positive, default=None,
+    help='maximum number of series per page'
+)
+catalog.add_argument(
+    'cursor', type=str, default=None,
+    help='continuation token of the previous page'
+)
 
 formula = base.copy()
 
@@ -166,11 +356,128 @@ register_formula.add_argument(
 )
 
 
-def blueprint(tsa):
+# below this size, compressing costs more than it saves
+MINSIZE = 512
+
+# the streamed histories are read by this many revisions at a time
+HISTORY_WINDOW = 32
+
+L = logging.getLogger('tshistory_rest')
+
+
+def serialization(fmt):
+    " the timing phase of the encoding of a read in the `fmt` format "
+    return 'json' if fmt in ('json', 'columnar') else 'serialize'
+
+
+def blueprint(tsa,
+              cache_size=0,
+              cache_ttl=60,
+              catalog_ttl=5,
+              encodings=None,
+              compresslevel=None,
+              zstdlevel=None,
+              timings=True,
+              slowlog=None,
+              coalesce=True,
+              prefetch=0,
+              prefetch_limit=4,
+              source_timeout=5,
+              source_workers=4):
+    """build the rest api blueprint over `tsa`
+
+    cache_size: number of series read responses kept in memory
+    (0 disables the cache)
+
+    cache_ttl: lifetime of the cached responses, in seconds
+
+    catalog_ttl: lifetime of the catalog snapshot, in seconds (0
+    disables the snapshot: each catalog page then reads and sorts the
+    whole catalog again)
+
+    encodings: content encodings offered to the clients for the json
+    responses, by order of preference (defaults to the available ones
+    among zstd, gzip and deflate, `('identity',)` disables it)
+
+    compresslevel: compression level of the gzip and deflate content
+    encodings and of the tshpack payloads, from 0 (no compression) to
+    9 (defaults to 6)
+
+    zstdlevel: compression level of the zstd content encoding, from 1
+    to 22 (defaults to 3)
+
+    timings: send the duration of the phases of the series reads
+    (parse, metadata, get, prefetch, json, serialize, compress) in a
+    Server-Timing header
+
+    slowlog: duration, in seconds, above which a read is logged with
+    its phases on the `tshistory_rest` logger (None disables it)
+
+    coalesce: let the identical series reads running concurrently
+    share one read and one serialized response
+
+    prefetch: number of threads reading concurrently the operands of
+    the local formulas served by the state reads (0 disables it, the
+    operands being then read one after the other) -- it should not
+    exceed what the database connection pool can serve
+
+    prefetch_limit: maximum number of operands read at once for a
+    given request
+
+    source_timeout: time, in seconds, given to the secondary sources
+    (asked all at once) to answer the catalog and series lookups; the
+    status of the sources asked is sent in a X-Source-Status header
+
+    source_workers: number of lookups a secondary source may run at
+    once; a source whose lookups all hang is not asked any more
+    (status `busy`) until one of them comes back
+    """
 
     # warn against playing proxy games
     assert isinstance(tsa, tsapi.dbtimeseries)
 
+    cache = lrucache(cache_size, cache_ttl) if cache_size else None
+    catalogs = lrucache(2, catalog_ttl) if catalog_ttl else None
+    flights = singleflight() if coalesce else None
+    # name -> date of the last metadata change (seen by this process)
+    metastamps = {}
+    others = fanout(
+        tsa.othersources.sources,
+        workers=source_workers,
+        timeout=source_timeout
+    )
+    operands = None
+    if prefetch and has_formula():
+        from tshistory_rest.prefetch import prefetched, prefetcher
+        operands = prefetcher(prefetch, prefetch_limit)
+
+    if encodings is None:
+        encodings = available_encodings()
+    encodings = tuple(
+        encoding for encoding in encodings
+        if encoding != 'identity'
+    )
+    unknown = set(encodings) - set(available_encodings())
+    assert not unknown, f'unavailable encodings: {unknown}'
+    assert compresslevel is None or 0 <= compresslevel <= 9, (
+        f'bad compresslevel: {compresslevel}'
+    )
+    assert zstdlevel is None or 1 <= zstdlevel <= 22, (
+        f'bad zstdlevel: {zstdlevel}'
+    )
+    levels = {
+        'gzip': compresslevel,
+        'deflate': compresslevel,
+        'zstd': zstdlevel
+    }
+    deflate = zlib.compress
+    if compresslevel is not None:
+        deflate = partial(zlib.compress, level=compresslevel)
+
+    def compressor(bytestr):
+        with phase('compress'):
+            return deflate(bytestr)
+
     bp = Blueprint(
         'tshistory_rest',
         __name__,
@@ -199,6 +506,468 @@ def blueprint(tsa):
         description='Time Series Operations'
     )
 
+    # phase timings
+
+    @contextmanager
+    def phase(name):
+        """ account the time spent in the block to the `name` phase
+        of the current request (phases may nest, e.g. compress within
+        serialize)
+        """
+        start = perf_counter()
+        try:
+            yield
+        finally:
+            # streamed responses run out of the request
+            if has_request_context():
+                spent = g.setdefault('tshr_timings', {})
+                spent[name] = spent.get(name, 0) + perf_counter() - start
+
+    @bp.before_request
+    def start_clock():
+        g.tshr_clock = perf_counter()
+
+    @bp.after_request
+    def report_timings(response):
+        spent = g.get('tshr_timings')
+        if not spent:
+            return response
+        total = perf_counter() - g.tshr_clock
+        if timings:
+            response.headers['Server-Timing'] = ', '.join(
+                f'{name};dur={duration * 1000:.2f}'
+                for name, duration in (*spent.items(), ('total', total))
+            )
+        if slowlog is not None and total >= slowlog:
+            L.warning(
+                'slow request %s %s (%.3fs): %s',
+                request.method, request.full_path, total,
+                ', '.join(
+                    f'{name}={duration:.3f}s'
+                    for name, duration in spent.items()
+                )
+            )
+        return response
+
+    @bp.after_request
+    def report_sources(response):
+        statuses = g.get('tshr_sources')
+        if statuses:
+            response.headers['X-Source-Status'] = ', '.join(
+                f'{name}={status}'
+                for name, status in statuses.items()
+            )
+        return response
+
+    def ask_sources(question):
+        """the answers of the secondary sources to `question(source)`
+        (see fanout.ask), their status being kept for the response
+
+        """
+        answers = others.ask(question)
+        statuses = g.setdefault('tshr_sources', {})
+        for source, _answer, status in answers:
+            statuses[sourcename(source)] = status
+        return answers
+
+    @bp.after_request
+    def negotiate_encoding(response):
+        # tshpack payloads come compressed already
+        if (not encodings or
+            response.status_code != 200 or
+            response.is_streamed or
+            'Content-Encoding' in response.headers or
+            response.mimetype not in ('application/json', 'text/json')):
+            return response
+
+        response.vary.add('Accept-Encoding')
+        data = response.get_data()
+        encoding = request.accept_encodings.best_match(encodings)
+        if encoding is None or len(data) < MINSIZE:
+            return response
+        with phase('compress'):
+            response.set_data(encode(encoding, data, levels[encoding]))
+        response.headers['Content-Encoding'] = encoding
+        return response
+
+    # per-request memo
+
+    def memo(func):
+        """ memoize `func` for the duration of the current request,
+        so that handlers and helpers can share their lookups
+        """
+        @wraps(func)
+        def memoized(*args):
+            memo = g.setdefault('tshr_memo', {})
+            key = (func.__name__, *args)
+            if key not in memo:
+                memo[key] = func(*args)
+            return memo[key]
+        return memoized
+
+    @memo
+    def local_metadata(name):
+        return tsa.tsh.metadata(tsa.engine, name)
+
+    @memo
+    def source_lookup(name):
+        """the tsa of the first secondary source holding a non-local
+        series (or None), and the sources which did not answer
+
+        """
+        if not tsa.othersources.sources:
+            return None, []
+        found = None
+        unavailable = []
+        for source, holds, status in ask_sources(
+                lambda source: source.tsa.exists(name)):
+            if status != 'ok':
+                unavailable.append(sourcename(source))
+            elif holds and found is None:
+                found = source.tsa
+        return found, unavailable
+
+    def source_tsa(name):
+        return source_lookup(name)[0]
+
+    def reader(name):
+        """the tsa holding a series: the local one or the secondary
+        source found by `source_lookup` -- so that the reads skip the
+        one source after the other lookups of tsa
+
+        """
+        if local_metadata(name):
+            return tsa
+        return source_tsa(name) or tsa
+
+    @memo
+    def internal_metadata(name):
+        # like tsa.metadata(name, all=True), telling apart local series
+        meta = local_metadata(name)
+        if meta:
+            return meta
+        sourcetsa = source_tsa(name)
+        if sourcetsa is None:
+            return None
+        return sourcetsa.metadata(name, all=True)
+
+    @memo
+    def series_status(name):
+        """`found`, `missing`, or `unavailable` when a series is not
+        found but some secondary sources did not answer
+
+        """
+        # an existing series has internal metadata
+        # so we can often spare the existence query
+        if internal_metadata(name) or tsa.tsh.exists(tsa.engine, name):
+            return 'found'
+        found, unavailable = source_lookup(name)
+        if found is not None:
+            return 'found'
+        return 'unavailable' if unavailable else 'missing'
+
+    def series_exists(name):
+        status = series_status(name)
+        if status == 'unavailable':
+            api.abort(
+                504,
+                f'`{name}`: no answer from the sources '
+                f'{", ".join(source_lookup(name)[1])}'
+            )
+        return status == 'found'
+
+    def served(name, *series, points=0):
+        " account the points of the series read (for the metrics) "
+        counts = g.setdefault('tshr_points', {})
+        counts[name] = counts.get(name, 0) + points + sum(
+            len(ts) for ts in series if ts is not None
+        )
+
+    # conditional & cached reads
+
+    def argskey(args):
+        return (
+            request.path,
+            *sorted((key, str(val)) for key, val in args.items())
+        )
+
+    def invalidate(*names, catalog=False):
+        if cache is not None:
+            cache.invalidate(*names)
+        if catalog and catalogs is not None:
+            catalogs.clear()
+
+    @memo
+    def last_insertion_date(name):
+        # only local primary series have a cheap answer
+        if not local_metadata(name):
+            return None
+        with tsa.engine.begin() as cn:
+            if tsa.tsh.type(cn, name) != 'primary':
+                return None
+            return tsa.tsh.latest_insertion_date(cn, name)
+
+    @memo
+    def formula_operands(name):
+        """the formulas (name -> text) read by a local formula,
+        itself included, and the other series they read -- or None
+        if `name` is not a formula
+
+        The `series` references are gathered from the formulas trees,
+        within one transaction.
+        """
+        if not has_formula() or not local_metadata(name):
+            return None
+        from psyl.lisp import parse
+
+        formulas = {}
+        primaries = set()
+        pending = [name]
+        with tsa.engine.begin() as cn:
+            while pending:
+                current = pending.pop()
+                if current in formulas or current in primaries:
+                    continue
+                text = tsa.tsh.formula(cn, current)
+                if text is None:
+                    if current == name:
+                        return None
+                    primaries.add(current)
+                    continue
+                formulas[current] = text
+                pending.extend(
+                    site[1]
+                    for site in tsa.tsh.find_callsites(cn, 'series', parse(text))
+                )
+        return formulas, primaries
+
+    def formula_dependencies(name):
+        """the names of the series a local formula reads, through the
+        formulas it reads too -- or None if `name` is not a formula,
+        or reads series of the secondary sources (whose writes we do
+        not see)
+
+        """
+        found = formula_operands(name)
+        if found is None:
+            return None
+        formulas, primaries = found
+        if not all(local_metadata(primary) for primary in primaries):
+            return None
+        return (set(formulas) - {name}) | primaries
+
+    def getseries(name, **getargs):
+        """like tsa.get, with the operands of the local formulas read
+        concurrently when the prefetch is enabled
+
+        """
+        found = formula_operands(name) if operands else None
+        if found is None:
+            return reader(name).get(name, **getargs)
+        formulas, primaries = found
+        with phase('prefetch'):
+            series = operands.fetch(
+                lambda dep: tsa.get(dep, **getargs),
+                primaries
+            )
+        with tsa.engine.begin() as cn:
+            ts = tsa.tsh.eval_formula(
+                cn,
+                formulas[name],
+                __interpreter__=prefetched(
+                    cn, tsa.tsh, getargs, series, formulas
+                )
+            )
+        if ts is not None:
+            ts.name = name
+        return ts
+
+    def validators(args):
+        """compute the (etag, last modification date) of a read
+        from the latest revision of the series, its metadata and
+        the read arguments -- or (None, None) when unknown
+
+        """
+        lastmodified = last_insertion_date(args.name)
+        if lastmodified is None:
+            return None, None
+        # a metadata change is a modification too
+        lastmodified = max(
+            lastmodified, metastamps.get(args.name, lastmodified)
+        )
+        etag = hashlib.sha1(
+            json.dumps([
+                lastmodified.isoformat(),
+                internal_metadata(args.name),
+                argskey(args)
+            ]).encode('utf-8')
+        ).hexdigest()
+        return etag, lastmodified
+
+    def paginate(args):
+        """restrict the value dates of a paged read to the current
+        page and return the cursor of the next one (or None)
+
+        The pages are `page_size` wide and walk the range from the
+        from_value_date to the to_value_date, the missing bounds
+        being those of the series. With a resampling, the pages start
+        on a period boundary (but the first one).
+        """
+        if args.page_size <= pd.Timedelta(0):
+            api.abort(400, 'the page size must be positive')
+        rule = args.resample
+        if rule is not None and (
+                not isinstance(rule, pd.offsets.Tick) or
+                pd.Timedelta(1, 'D') % rule.delta != pd.Timedelta(0) or
+                args.page_size % rule.delta != pd.Timedelta(0)):
+            # or the periods would straddle the pages
+            api.abort(
+                400, 'the page size must be a whole number of periods, '
+                'of a day at most'
+            )
+        if not series_exists(args.name):
+            api.abort(404, f'`{args.name}` does not exists')
+
+        start, end = args.from_value_date, args.to_value_date
+        if args.cursor:
+            try:
+                start = pd.Timestamp(decode_cursor(args.cursor))
+            except (TypeError, ValueError):
+                api.abort(400, f'bad cursor `{args.cursor}`')
+        if start is None or end is None:
+            try:
+                ival = reader(args.name).interval(args.name)
+            except ValueError:
+                api.abort(
+                    400, f'`{args.name}`: paging needs explicit value dates'
+                )
+            if start is None:
+                start = ival.left
+            if end is None:
+                end = ival.right
+
+        # the bounds follow the series: utc ones or naive ones
+        tzaware = internal_metadata(args.name).get('tzaware', False)
+
+        def stamp(date):
+            if date.tzinfo is None:
+                return date.tz_localize('UTC') if tzaware else date
+            date = date.tz_convert('UTC')
+            return date if tzaware else date.tz_localize(None)
+
+        start, end = stamp(start), stamp(end)
+        stop = start + args.page_size
+        if args.resample is not None:
+            # the pages hold whole periods: they follow the periods grid
+            stop = start.floor(args.resample) + args.page_size
+        args.from_value_date = start
+        # the value date bounds are inclusive
+        args.to_value_date = min(end, stop - pd.Timedelta(1, 'us'))
+        if stop > end:
+            return None
+        return encode_cursor(stop.isoformat())
+
+    def paged(args, read):
+        " serve a read, page by page if asked to "
+        if args.page_size is None:
+            return serve(args, read)
+        cursor = paginate(args)
+        response = serve(args, read)
+        if cursor is not None:
+            response.headers['X-Next-Cursor'] = cursor
+        return response
+
+    def resampler(args):
+        " the resampling function of a read "
+        if args.resample is None:
+            return lambda series: series
+        if (args.how not in ('min', 'max', 'last') and
+            internal_metadata(args.name)['value_type'] == 'object'):
+            api.abort(
+                400, f'`{args.name}`: cannot {args.how} string values'
+            )
+        return partial(resample, rule=args.resample, how=args.how)
+
+    def coalesced(key, etag, args, read):
+        """call `read(args)`, or share the response of the identical
+        read another thread is running
+
+        """
+        def compute():
+            response = read(args)
+            return (
+                response,
+                response.get_data(),
+                response.headers['Content-Type'],
+                g.get('tshr_points', {}).get(args.name)
+            )
+
+        # a read started before a write does not serve the new etag
+        (response, body, mimetype, points), shared = flights.do(
+            (key, etag), compute
+        )
+        if not shared:
+            return response
+        if points:
+            served(args.name, points=points)
+        response = make_response(body)
+        response.headers['Content-Type'] = mimetype
+        return response
+
+    def serve(args, read):
+        """serve a read of the `args.name` series through the
+        response cache and the conditional request validators,
+        `read(args)` being called for the actual response
+
+        """
+        key = argskey(args)
+        entry = cache.get(key) if cache is not None else None
+        if entry is None:
+            with phase('metadata'):
+                exists = series_exists(args.name)
+                etag, lastmodified = (
+                    validators(args) if exists else (None, None)
+                )
+            if not exists:
+                api.abort(404, f'`{args.name}` does not exists')
+        else:
+            body, mimetype, etag, lastmodified, points = entry
+
+        if fresh(etag, lastmodified):
+            return not_modified(etag, lastmodified)
+
+        if entry is not None:
+            if points:
+                served(args.name, points=points)
+            response = make_response(body)
+            response.headers['Content-Type'] = mimetype
+            return conditional(response, etag, lastmodified)
+
+        # only the series we know how to invalidate go in: the
+        # primary ones, and the formulas through their operands
+        depends = None
+        if cache is not None and not args.get('stream'):
+            depends = () if etag is not None else formula_dependencies(args.name)
+        if depends is not None:
+            # a write landing during the read makes it stale
+            generation = cache.generation(args.name, *depends)
+
+        # without an etag, nothing tells apart the reads around a write
+        if flights is None or etag is None or args.get('stream'):
+            response = read(args)
+        else:
+            response = coalesced(key, etag, args, read)
+        if depends is not None and not response.is_streamed:
+            cache.set(
+                args.name, key,
+                (response.get_data(), response.headers['Content-Type'],
+                 etag, lastmodified,
+                 g.get('tshr_points', {}).get(args.name)),
+                depends=depends,
+                generation=generation
+            )
+        return conditional(response, etag, lastmodified)
+
 
     # routes
 
@@ -208,22 +977,28 @@ def blueprint(tsa):
         @api.expect(metadata)
         def get(self):
             args = metadata.parse_args()
-            if not tsa.exists(args.name):
+            if not series_exists(args.name):
                 api.abort(404, f'`{args.name}` does not exists')
 
             if args.type == 'standard':
-                meta = tsa.metadata(args.name, all=args.all)
+                meta = internal_metadata(args.name)
+                if meta and not args.all:
+                    meta = {
+                        key: val
+                        for key, val in meta.items()
+                        if key not in tsa.tsh.metakeys
+                    }
                 return meta, 200
             elif args.type == 'type':
-                stype = tsa.type(args.name)
+                stype = reader(args.name).type(args.name)
                 return stype, 200
             else:
                 assert args.type == 'interval'
                 try:
-                    ival = tsa.interval(args.name)
+                    ival = reader(args.name).interval(args.name)
                 except ValueError as err:
                     return no_content()
-                tzaware = tsa.metadata(args.name, all=True).get('tzaware', False)
+                tzaware = internal_metadata(args.name).get('tzaware', False)
                 return (tzaware,
                         ival.left.isoformat(),
                         ival.right.isoformat()), 200
@@ -237,10 +1012,13 @@ def blueprint(tsa):
             metadata = json.loads(args.metadata)
             try:
                 tsa.update_metadata(args.name, metadata)
+                metastamps[args.name] = pd.Timestamp.now(tz='UTC')
             except ValueError as err:
                 if err.args[0].startswith('not allowed to'):
                     api.abort(405, err.args[0])
                 raise
+            finally:
+                invalidate(args.name)
 
             return '', 200
 
@@ -251,7 +1029,20 @@ def blueprint(tsa):
         @api.expect(update)
         def patch(self):
             args = update.parse_args()
-            series = util.fromjson(args.series, args.name, args.tzaware)
+            if request.mimetype == 'application/octet-stream':
+                # fast path: the tshpack layout of the state reads
+                try:
+                    _meta, series = binary_unpack_meta_data(
+                        request.get_data(), args.name
+                    )
+                except UNPACK_ERRORS:
+                    api.abort(400, f'`{args.name}`: bad tshpack payload')
+                # like fromjson, give floats to the numerical series
+                series = util.num2float(series)
+            elif args.series is None:
+                api.abort(400, f'`{args.name}`: no series provided')
+            else:
+                series = util.fromjson(args.series, args.name, args.tzaware)
             exists = tsa.exists(args.name)
             try:
                 if args.replace:
@@ -270,6 +1061,8 @@ def blueprint(tsa):
                 if err.args[0].startswith('not allowed to'):
                     api.abort(405, err.args[0])
                 raise
+            finally:
+                invalidate(args.name, catalog=not exists)
 
             return '', 200 if exists else 201
 
@@ -287,42 +1080,62 @@ def blueprint(tsa):
                 if err.args[0].startswith('not allowed to'):
                     api.abort(405, err.args[0])
                 raise
+            finally:
+                invalidate(args.name, args.newname, catalog=True)
 
             return no_content()
 
         @api.expect(get)
         def get(self):
-            args = get.parse_args()
-            if not tsa.exists(args.name):
-                api.abort(404, f'`{args.name}` does not exists')
+            with phase('parse'):
+                args = get.parse_args()
+            return paged(args, self.read)
 
-            series = tsa.get(
-                args.name,
-                revision_date=args.insertion_date,
-                from_value_date=args.from_value_date,
-                to_value_date=args.to_value_date
-            )
+        def read(self, args):
+            with phase('get'):
+                series = getseries(
+                    args.name,
+                    revision_date=args.insertion_date,
+                    from_value_date=args.from_value_date,
+                    to_value_date=args.to_value_date
+                )
+                series = resampler(args)(series)
+            served(args.name, series)
             # the fast path will need it
             # also it is read from a cache filled at get time
             # so very cheap call
-            metadata = tsa.metadata(args.name, all=True)
-
-            if args.format == 'json':
-                if series is not None:
+            with phase('metadata'):
+                metadata = internal_metadata(args.name)
+
+            with phase(serialization(args.format)):
+                if args.format == 'json':
+                    if series is not None:
+                        response = make_response(
+                            series.to_json(orient='index',
+                                           date_format='iso')
+                        )
+                    else:
+                        response = make_response('null')
+                    response.headers['Content-Type'] = 'text/json'
+                    return response
+
+                if args.format == 'columnar':
                     response = make_response(
-                        series.to_json(orient='index',
-                                       date_format='iso')
+                        columnar_json(series, metadata['tzaware'])
                     )
-                else:
-                    response = make_response('null')
-                response.headers['Content-Type'] = 'text/json'
-                return response
+                    response.headers['Content-Type'] = 'application/json'
+                    return response
 
-            response = make_response(
-                binary_pack_meta_data(metadata, series)
-            )
-            response.headers['Content-Type'] = 'application/octet-stream'
-            return response
+                if args.format == 'arrow':
+                    response = make_response(arrow_series(metadata, series))
+                    response.headers['Content-Type'] = ARROW_MIMETYPE
+                    return response
+
+                response = make_response(
+                    binary_pack_meta_data(metadata, series, compressor)
+                )
+                response.headers['Content-Type'] = 'application/octet-stream'
+                return response
 
         @api.expect(delete)
         def delete(self):
@@ -336,6 +1149,8 @@ def blueprint(tsa):
                 if err.args[0].startswith('not allowed to'):
                     api.abort(405, err.args[0])
                 raise
+            finally:
+                invalidate(args.name, catalog=True)
 
             return no_content()
 
@@ -344,81 +1159,670 @@ def blueprint(tsa):
 
         @api.expect(history)
         def get(self):
-            args = history.parse_args()
-            if not tsa.exists(args.name):
-                api.abort(404, f'`{args.name}` does not exists')
+            with phase('parse'):
+                args = history.parse_args()
+            return paged(args, self.read)
 
-            hist = tsa.history(
-                args.name,
-                from_insertion_date=args.from_insertion_date,
-                to_insertion_date=args.to_insertion_date,
-                from_value_date=args.from_value_date,
-                to_value_date=args.to_value_date,
-                diffmode=args.diffmode,
-                _keep_nans=args._keep_nans
-            )
-            metadata = tsa.metadata(args.name, all=True)
+        def read(self, args):
+            if args.stream:
+                return self.stream(args)
 
-            if args.format == 'json':
-                if hist is not None:
+            with phase('get'):
+                hist = reader(args.name).history(
+                    args.name,
+                    from_insertion_date=args.from_insertion_date,
+                    to_insertion_date=args.to_insertion_date,
+                    from_value_date=args.from_value_date,
+                    to_value_date=args.to_value_date,
+                    diffmode=args.diffmode,
+                    _keep_nans=args._keep_nans
+                )
+                if hist and args.resample is not None:
+                    resampled = resampler(args)
+                    hist = {
+                        idate: resampled(series)
+                        for idate, series in hist.items()
+                    }
+            served(args.name, *(hist or {}).values())
+            with phase('metadata'):
+                metadata = internal_metadata(args.name)
+
+            with phase(serialization(args.format)):
+                if args.format == 'json':
+                    if hist is not None:
+                        response = make_response(
+                            pd.DataFrame(hist).to_json()
+                        )
+                    else:
+                        response = make_response('null')
+                    response.headers['Content-Type'] = 'text/json'
+                    return response
+
+                if args.format == 'columnar':
                     response = make_response(
-                        pd.DataFrame(hist).to_json()
+                        columnar_history(hist, metadata['tzaware'])
                     )
-                else:
-                    response = make_response('null')
-                response.headers['Content-Type'] = 'text/json'
+                    response.headers['Content-Type'] = 'application/json'
+                    return response
+
+                if args.format == 'arrow':
+                    response = make_response(
+                        b''.join(
+                            arrow_history_chunks(metadata, (hist or {}).items())
+                        )
+                    )
+                    response.headers['Content-Type'] = ARROW_MIMETYPE
+                    return response
+
+                response = make_response(
+                    pack_history(metadata, hist, compressor)
+                )
+                response.headers['Content-Type'] = 'application/octet-stream'
                 return response
 
-            response = make_response(
-                util.pack_history(metadata, hist)
+        def revisions(self, args, primary, sourcetsa):
+            """yield the (insertion date, series) items of the history
+            one at a time, reading them by windows of
+            `HISTORY_WINDOW` revisions, so that only one window is
+            held in memory
+
+            """
+            if not primary:
+                # formula or secondary source: no revision-wise access
+                yield from (sourcetsa.history(
+                    args.name,
+                    from_insertion_date=args.from_insertion_date,
+                    to_insertion_date=args.to_insertion_date,
+                    from_value_date=args.from_value_date,
+                    to_value_date=args.to_value_date,
+                    diffmode=args.diffmode,
+                    _keep_nans=args._keep_nans
+                ) or {}).items()
+                return
+
+            # the diffs are computed on the full states, like history does
+            keepnans = args._keep_nans or args.diffmode
+            idates = tsa.tsh.insertion_dates(
+                tsa.engine, args.name,
+                fromdate=args.from_insertion_date,
+                todate=args.to_insertion_date
             )
-            response.headers['Content-Type'] = 'application/octet-stream'
-            return response
+            previous = None
+            if args.diffmode and idates and args.from_insertion_date:
+                # the diffs start from the state before the first revision
+                before = [
+                    idate
+                    for idate in tsa.tsh.insertion_dates(
+                        tsa.engine, args.name,
+                        todate=args.from_insertion_date
+                    )
+                    if idate < idates[0]
+                ]
+                if before:
+                    previous = tsa.tsh.get(
+                        tsa.engine, args.name,
+                        revision_date=before[-1],
+                        from_value_date=args.from_value_date,
+                        to_value_date=args.to_value_date,
+                        _keep_nans=True
+                    )
+
+            pruning = args.from_value_date or args.to_value_date
+            for start in range(0, len(idates), HISTORY_WINDOW):
+                window = idates[start:start + HISTORY_WINDOW]
+                hist = tsa.tsh.history(
+                    tsa.engine, args.name,
+                    from_insertion_date=window[0],
+                    to_insertion_date=window[-1],
+                    from_value_date=args.from_value_date,
+                    to_value_date=args.to_value_date,
+                    _keep_nans=keepnans
+                ) or {}
+                for idate, series in hist.items():
+                    if series is None or (pruning and not len(series)):
+                        continue
+                    if args.diffmode:
+                        diff = (
+                            series if previous is None
+                            else tsa.tsh.diff(previous, series)
+                        )
+                        previous = series
+                        if len(diff):
+                            yield idate, diff
+                        continue
+                    if (pruning and previous is not None and
+                        series.equals(previous)):
+                        continue
+                    previous = series
+                    yield idate, series
+
+        def stream(self, args):
+            metadata = internal_metadata(args.name)
+            resampled = resampler(args)
+            # the local primary series only have revision-wise reads
+            primary = last_insertion_date(args.name) is not None
+            sourcetsa = reader(args.name)
+            revisions = (
+                (idate, resampled(series))
+                for idate, series in self.revisions(args, primary, sourcetsa)
+            )
+
+            if args.format in ('json', 'columnar'):
+                if args.format == 'json':
+                    dump = partial(
+                        pd.Series.to_json, orient='index', date_format='iso'
+                    )
+                else:
+                    dump = partial(
+                        columnar_json, tzaware=metadata['tzaware']
+                    )
+
+                def chunks():
+                    for idate, series in revisions:
+                        yield '{{{}: {}}}\n'.format(
+                            json.dumps(idate.isoformat()),
+                            dump(series)
+                        )
+                return Response(chunks(), mimetype='application/x-ndjson')
+
+            if args.format == 'arrow':
+                return Response(
+                    arrow_history_chunks(metadata, revisions),
+                    mimetype=ARROW_MIMETYPE
+                )
+
+            def chunks():
+                yield frame(json.dumps(metadata).encode('utf-8'))
+                for idate, series in revisions:
+                    yield pack_history_chunk(metadata, idate, series, compressor)
+            return Response(chunks(), mimetype='application/octet-stream')
 
     @ns.route('/staircase')
     class timeseries_staircase(Resource):
 
         @api.expect(staircase)
         def get(self):
-            args = staircase.parse_args()
-            if not tsa.exists(args.name):
-                api.abort(404, f'`{args.name}` does not exists')
+            with phase('parse'):
+                args = staircase.parse_args()
+            return serve(args, self.read)
+
+        def read(self, args):
+            if len(args.delta) > 1:
+                return self.readmany(args)
+
+            [delta] = args.delta
+            with phase('get'):
+                series = reader(args.name).staircase(
+                    args.name, delta=delta,
+                    from_value_date=args.from_value_date,
+                    to_value_date=args.to_value_date,
+                )
+                series = resampler(args)(series)
+            served(args.name, series)
+            with phase('metadata'):
+                metadata = internal_metadata(args.name)
+
+            with phase(serialization(args.format)):
+                if args.format == 'json':
+                    if series is not None:
+                        response = make_response(
+                            series.to_json(orient='index', date_format='iso')
+                        )
+                    else:
+                        response = make_response('null')
+                    response.headers['Content-Type'] = 'text/json'
+                    return response
+
+                if args.format == 'columnar':
+                    response = make_response(
+                        columnar_json(series, metadata['tzaware'])
+                    )
+                    response.headers['Content-Type'] = 'application/json'
+                    return response
+
+                if args.format == 'arrow':
+                    response = make_response(arrow_series(metadata, series))
+                    response.headers['Content-Type'] = ARROW_MIMETYPE
+                    return response
+
+                response = make_response(
+                    binary_pack_meta_data(metadata, series, compressor)
+                )
+                response.headers['Content-Type'] = 'application/octet-stream'
+                return response
+
+        def readmany(self, args):
+            """several staircases of a series, as a json object or a
+            multi-series tshpack keyed by delta (iso 8601 duration)
+
+            """
+            if args.format == 'arrow':
+                api.abort(400, 'the arrow format takes one delta only')
+
+            deltas = sorted(set(args.delta))
+            with phase('get'):
+                stairs = self.staircases(args, deltas)
+                resampled = resampler(args)
+                stairs = {
+                    delta: resampled(series)
+                    for delta, series in stairs.items()
+                }
+            served(args.name, *stairs.values())
+            with phase('metadata'):
+                metadata = internal_metadata(args.name)
+
+            with phase(serialization(args.format)):
+                if args.format in ('json', 'columnar'):
+                    if args.format == 'json':
+                        dump = partial(
+                            pd.Series.to_json,
+                            orient='index', date_format='iso'
+                        )
+                    else:
+                        dump = partial(
+                            columnar_json, tzaware=metadata['tzaware']
+                        )
+                    response = make_response(
+                        '{{{}}}'.format(
+                            ', '.join(
+                                '{}: {}'.format(
+                                    json.dumps(delta.isoformat()),
+                                    dump(series) if series is not None
+                                    else 'null'
+                                )
+                                for delta, series in stairs.items()
+                            )
+                        )
+                    )
+                    response.headers['Content-Type'] = (
+                        'text/json' if args.format == 'json'
+                        else 'application/json'
+                    )
+                    return response
+
+                response = make_response(
+                    binary_pack_many(
+                        {'name': args.name},
+                        [
+                            ({'delta': delta.isoformat(), 'meta': metadata},
+                             series)
+                            for delta, series in stairs.items()
+                        ],
+                        compressor
+                    )
+                )
+                response.headers['Content-Type'] = 'application/octet-stream'
+                return response
+
+        def staircases(self, args, deltas):
+            """compute the staircases of the `deltas` from one read of
+            the history -- for the local primary series, the others
+            being computed one delta at a time
+
+            """
+            if last_insertion_date(args.name) is None:
+                sourcetsa = reader(args.name)
+                return {
+                    delta: sourcetsa.staircase(
+                        args.name, delta=delta,
+                        from_value_date=args.from_value_date,
+                        to_value_date=args.to_value_date
+                    )
+                    for delta in deltas
+                }
+
+            # same as tsh.staircase, with a history read that covers
+            # the smallest delta, hence all of them
+            with tsa.engine.begin() as cn:
+                base = tsa.tsh.get(
+                    cn, args.name,
+                    from_value_date=args.from_value_date,
+                    to_value_date=args.to_value_date,
+                    _keep_nans=True
+                )
+                if not len(base):
+                    return {
+                        delta: pd.Series(name=args.name, dtype='float64')
+                        for delta in deltas
+                    }
+                hcache = historycache(
+                    tsa.tsh, cn, args.name,
+                    from_value_date=args.from_value_date,
+                    to_value_date=args.to_value_date,
+                    to_insertion_date=base.index.max() - deltas[0],
+                    tzaware=internal_metadata(args.name)['tzaware']
+                )
+
+            stairs = {}
+            for delta in deltas:
+                # the state as of the last revision this delta can see
+                state = hcache.get(
+                    revision_date=base.index.max() - delta,
+                    from_value_date=args.from_value_date,
+                    to_value_date=args.to_value_date
+                )
+                chunks = [
+                    ts for ts in (
+                        hcache.get(
+                            revision_date=vdate - delta,
+                            from_value_date=vdate,
+                            to_value_date=vdate
+                        )
+                        for vdate in state.index
+                    )
+                    if len(ts)
+                ]
+                series = pd.concat(chunks) if chunks else pd.Series(
+                    dtype='float64'
+                )
+                series.name = args.name
+                stairs[delta] = series
+            return stairs
+
+    @ns.route('/insertion_dates')
+    class timeseries_idates(Resource):
+
+        @api.expect(insertion_dates)
+        def get(self):
+            args = insertion_dates.parse_args()
+            return serve(args, self.read)
+
+        def read(self, args):
+            # the revisions only, no series materialization
+            sourcetsa = reader(args.name)
+            tsh = sourcetsa.tsh
+            with sourcetsa.engine.begin() as cn:
+                idates = tsh.insertion_dates(
+                    cn, args.name,
+                    fromdate=args.from_insertion_date,
+                    todate=args.to_insertion_date
+                )
+                if tsh.type(cn, args.name) == 'formula':
+                    # the (changeset, insertion date) pairs of the operands
+                    idates = sorted({idate for _csid, idate in idates})
+            idates = idates[:args.limit]
+
+            if args.format == 'json':
+                response = make_response(
+                    json.dumps([idate.isoformat() for idate in idates])
+                )
+                response.headers['Content-Type'] = 'application/json'
+                return response
 
-            series = tsa.staircase(
-                args.name, delta=args.delta,
-                from_value_date=args.from_value_date,
-                to_value_date=args.to_value_date,
+            response = make_response(
+                pack_insertion_dates(idates, compressor)
             )
-            metadata = tsa.metadata(args.name, all=True)
+            response.headers['Content-Type'] = 'application/octet-stream'
+            return response
+
+    @ns.route('/changes')
+    class timeseries_changes(Resource):
+
+        @api.expect(changes)
+        def get(self):
+            args = changes.parse_args()
+            return serve(args, self.read)
+
+        def read(self, args):
+            """the points changed by the revisions inserted after
+            `since` (erased points come as nans), and the insertion
+            date to ask the next changes from
+
+            """
+            since = args.since
+            if since is not None and since.tzinfo is None:
+                # the insertion dates are utc
+                since = since.tz_localize('UTC')
+            sourcetsa = reader(args.name)
+            tsh = sourcetsa.tsh
+            # read the latest insertion date first, so that nothing
+            # inserted meanwhile is reported as seen
+            with sourcetsa.engine.begin() as cn:
+                if tsh.type(cn, args.name) == 'formula':
+                    # the (changeset, insertion date) pairs of the operands
+                    latest = max(
+                        (idate
+                         for _csid, idate in tsh.insertion_dates(
+                                 cn, args.name, fromdate=since
+                         )),
+                        default=since
+                    )
+                else:
+                    latest = tsh.latest_insertion_date(cn, args.name)
+
+            series = None
+            if latest is not None and (since is None or latest > since):
+                # the state seen by the replica vs the latest one
+                old = None
+                if since is not None:
+                    old = sourcetsa.get(args.name, revision_date=since)
+                new = sourcetsa.get(args.name, revision_date=latest)
+                series = tsh.diff(old, new)
+                if old is not None:
+                    erased = old.index.difference(new.index)
+                    if len(erased):
+                        series = pd.concat([
+                            series,
+                            pd.Series(np.nan, index=erased, dtype=new.dtype)
+                        ]).sort_index()
+                served(args.name, series)
+            metadata = internal_metadata(args.name)
+
+            header = {
+                'name': args.name,
+                'since': since and since.isoformat(),
+                'last_insertion_date': latest and latest.isoformat()
+            }
 
             if args.format == 'json':
+                # assemble the json text, as for the bulk reads
+                changed = '{}'
                 if series is not None:
-                    response = make_response(
+                    changed = series.to_json(orient='index', date_format='iso')
+                response = make_response(
+                    json.dumps(header)[:-1] + f', "changes": {changed}}}'
+                )
+                response.headers['Content-Type'] = 'text/json'
+                return response
+
+            response = make_response(
+                binary_pack_many(
+                    header,
+                    [({'meta': metadata}, series)],
+                    compressor
+                )
+            )
+            response.headers['Content-Type'] = 'application/octet-stream'
+            return response
+
+    @ns.route('/bulk')
+    class timeseries_bulk(Resource):
+
+        @api.expect(bulk_get)
+        def get(self):
+            args = bulk_get.parse_args()
+            found = []
+            missing = []
+            # not found, but some sources did not answer
+            unavailable = []
+            for name in args.name:
+                status = series_status(name)
+                if status != 'found':
+                    (missing if status == 'missing' else unavailable).append(name)
+                    continue
+                series = reader(name).get(
+                    name,
+                    revision_date=args.insertion_date,
+                    from_value_date=args.from_value_date,
+                    to_value_date=args.to_value_date
+                )
+                served(name, series)
+                found.append((name, internal_metadata(name), series))
+
+            if args.format == 'json':
+                # assemble the json text to avoid a decode/encode
+                # round trip of each series
+                series = ', '.join(
+                    '{}: {}'.format(
+                        json.dumps(name),
                         series.to_json(orient='index', date_format='iso')
+                        if series is not None else 'null'
                     )
-                else:
-                    response = make_response('null')
+                    for name, _meta, series in found
+                )
+                unknown = f'"missing": {json.dumps(missing)}'
+                if unavailable:
+                    unknown += f', "unavailable": {json.dumps(unavailable)}'
+                response = make_response(
+                    f'{{"series": {{{series}}}, {unknown}}}'
+                )
                 response.headers['Content-Type'] = 'text/json'
                 return response
 
             response = make_response(
-                binary_pack_meta_data(metadata, series)
+                binary_pack_many(
+                    {'missing': missing,
+                     **({'unavailable': unavailable} if unavailable else {})},
+                    [
+                        ({'name': name, 'meta': meta}, series)
+                        for name, meta, series in found
+                    ],
+                    compressor
+                )
             )
             response.headers['Content-Type'] = 'application/octet-stream'
             return response
 
+        @api.expect(bulk_update)
+        def patch(self):
+            args = bulk_update.parse_args()
+            if request.mimetype != 'application/octet-stream':
+                api.abort(400, 'a tshpack body is expected')
+            try:
+                _header, entries = binary_unpack_many(request.get_data())
+            except UNPACK_ERRORS:
+                api.abort(400, 'bad tshpack payload')
+            names = [entry.get('name') for entry, _series in entries]
+            if not all(isinstance(name, str) and name for name in names):
+                api.abort(400, 'all the entries must have a name')
+            duplicates = sorted(
+                name for name, count in Counter(names).items() if count > 1
+            )
+            if duplicates:
+                api.abort(400, f'duplicated names: {", ".join(duplicates)}')
+
+            status = {}
+            try:
+                # one transaction for the whole batch
+                with tsa.engine.begin() as cn:
+                    txtsa = copy(tsa)
+                    txtsa.engine = cn
+                    for (entry, series), name in zip(entries, names):
+                        exists = tsa.tsh.exists(cn, name)
+                        write = txtsa.replace if entry.get('replace') else txtsa.update
+                        diff = write(
+                            name, util.num2float(series), args.author,
+                            metadata=entry.get('metadata'),
+                            insertion_date=args.insertion_date
+                        )
+                        if diff is None or not len(diff):
+                            status[name] = 'unchanged'
+                        else:
+                            status[name] = 'updated' if exists else 'created'
+            except ValueError as err:
+                if err.args[0].startswith('not allowed to'):
+                    api.abort(405, err.args[0])
+                raise
+            finally:
+                invalidate(
+                    *names,
+                    catalog='created' in status.values()
+                )
+
+            return status, 200
+
     @ns.route('/catalog')
     class timeseries_catalog(Resource):
 
         @api.expect(catalog)
         def get(self):
             args = catalog.parse_args()
-            cat = {
-                f'{uri}!{ns}': series
-                for (uri, ns), series in tsa.catalog(allsources=args.allsources).items()
-            }
+            cat = self.snapshot(args.allsources)
+
+            if args.pattern or args.kind:
+                cat = {
+                    source: [
+                        (name, kind)
+                        for name, kind in series
+                        if (args.kind is None or kind == args.kind) and
+                        (args.pattern is None or fnmatchcase(name, args.pattern))
+                    ]
+                    for source, series in cat.items()
+                }
+                cat = {
+                    source: series
+                    for source, series in cat.items()
+                    if series
+                }
+
+            if args.limit is None and args.cursor is None:
+                return cat
+
+            # pagination over the (source, name) ordering
+            items = sorted(
+                (source, name, kind)
+                for source, series in cat.items()
+                for name, kind in series
+            )
+            if args.cursor:
+                try:
+                    source, name = decode_cursor(args.cursor)
+                    if not isinstance(source, str) or not isinstance(name, str):
+                        raise ValueError('bad cursor')
+                except (TypeError, ValueError):
+                    api.abort(400, f'bad cursor `{args.cursor}`')
+                items = items[bisect.bisect_right(items, (source, name, '\uffff')):]
+            page = items[:args.limit] if args.limit else items
+
+            cat = {}
+            for source, name, kind in page:
+                cat.setdefault(source, []).append((name, kind))
+            headers = {}
+            if len(page) < len(items):
+                headers['X-Next-Cursor'] = encode_cursor(page[-1][:2])
+            return cat, 200, headers
+
+        def snapshot(self, allsources):
+            cat = None
+            if catalogs is not None:
+                cat = catalogs.get(allsources)
+            if cat is None:
+                cat = {
+                    f'{uri}!{ns}': series
+                    for (uri, ns), series in tsa.catalog(allsources=False).items()
+                }
+                complete = True
+                if allsources and tsa.othersources.sources:
+                    for _source, answer, status in ask_sources(
+                            lambda source: source.tsa.catalog(allsources=True)):
+                        if status != 'ok':
+                            complete = False
+                            continue
+                        for (uri, ns), series in answer.items():
+                            cat[f'{uri}!{ns}'] = series
+                # a partial catalog is not a snapshot
+                if catalogs is not None and complete:
+                    catalogs.set('catalog', allsources, cat)
             return cat
 
+    if cache is not None:
+
+        @ns.route('/cache')
+        class timeseries_cache(Resource):
+
+            def get(self):
+                return cache.stats(), 200
+
     if not has_formula():
         return bp
 
@@ -430,13 +1834,12 @@ def blueprint(tsa):
         @api.expect(formula)
         def get(self):
             args = formula.parse_args()
-            if not tsa.exists(args.name):
-                api.abort(404, f'`{args.name}` does not exists')
-
-            if not tsa.type(args.name):
+            form = tsa.formula(args.name)
+            if form is None:
+                if not series_exists(args.name):
+                    api.abort(404, f'`{args.name}` does not exists')
                 api.abort(409, f'`{args.name}` exists but is not a formula')
 
-            form = tsa.formula(args.name)
             return form, 200
 
 
@@ -463,6 +1866,7 @@ def blueprint(tsa):
             except Exception:
                 raise
 
+            invalidate(args.name, catalog=not exists)
             return '', 200 if exists else 201
 
     return bp
@@ -0,0 +1,174 @@
+from collections import (
+    defaultdict,
+    OrderedDict
+)
+import threading
+import time
+
+
+class lrucache:
+    """A size-bounded, time-limited, thread-safe cache whose entries
+    belong to a series name, so that all the entries of a series can
+    be dropped at once when it changes. An entry may also depend on
+    other series (e.g. the operands of a formula), and is then dropped
+    when any of them changes.
+
+    It lives in the process: writes made through another process
+    only become visible once the entries expire.
+
+    Each name has a generation, bumped by its invalidation: a value
+    computed while one of its names was invalidated is stale, and is
+    refused by `set` when given the `generation` taken before.
+    """
+    __slots__ = (
+        'maxsize', 'ttl',
+        'entries', 'names', 'generations', 'epoch',
+        'lock', 'hits', 'misses'
+    )
+
+    def __init__(self, maxsize=256, ttl=60):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.entries = OrderedDict()  # key -> (names, expiry, value)
+        self.names = defaultdict(set)  # name -> keys
+        self.generations = {}  # name -> invalidations count
+        self.epoch = 0  # clears count
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            _names, expiry, value = entry
+            if expiry < time.monotonic():
+                self._drop(key)
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def generation(self, *names):
+        " an opaque token to give to `set` "
+        with self.lock:
+            return self._generation(names)
+
+    def set(self, name, key, value, depends=(), generation=None):
+        """cache `value` unless `generation` was taken before an
+        invalidation of `name` or `depends`, and tell if it was
+
+        """
+        names = (name, *depends)
+        with self.lock:
+            if generation is not None and generation != self._generation(names):
+                return False
+            if key in self.entries:
+                self._drop(key)
+            self.entries[key] = (names, time.monotonic() + self.ttl, value)
+            for name in names:
+                self.names[name].add(key)
+            while len(self.entries) > self.maxsize:
+                self._drop(next(iter(self.entries)))
+        return True
+
+    def invalidate(self, *names):
+        with self.lock:
+            for name in names:
+                self.generations[name] = self.generations.get(name, 0) + 1
+                for key in list(self.names.get(name, ())):
+                    self._drop(key)
+
+    def clear(self):
+        with self.lock:
+            self.epoch += 1
+            self.entries.clear()
+            self.names.clear()
+
+    def stats(self):
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'entries': len(self.entries),
+            'maxsize': self.maxsize,
+            'ttl': self.ttl
+        }
+
+    def _generation(self, names):
+        return (
+            self.epoch,
+            *(self.generations.get(name, 0) for name in sorted(set(names)))
+        )
+
+    def _drop(self, key):
+        names, _expiry, _value = self.entries.pop(key)
+        for name in names:
+            keys = self.names.get(name)
+            if keys is not None:
+                keys.discard(key)
+                if not keys:
+                    del self.names[name]
+
+
+class flight:
+    __slots__ = ('done', 'result', 'error')
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class singleflight:
+    """Coalesce the concurrent calls made for the same key: the first
+    caller computes the result, the ones arriving meanwhile wait for
+    it and share it (or its exception).
+
+    A caller waiting more than `timeout` seconds stops waiting and
+    makes its own call.
+    """
+    __slots__ = ('lock', 'flights', 'timeout')
+
+    def __init__(self, timeout=30):
+        self.lock = threading.Lock()
+        self.flights = {}  # key -> flight
+        self.timeout = timeout
+
+    def do(self, key, func):
+        """return (func(), shared) where shared tells if the result
+        comes from a call made by another thread
+
+        """
+        with self.lock:
+            current = self.flights.get(key)
+            leader = current is None
+            if leader:
+                current = self.flights[key] = flight()
+
+        if not leader:
+            if not self.wait(current):
+                return func(), False
+            if current.error is not None:
+                raise current.error
+            return current.result, True
+
+        try:
+            current.result = func()
+        except BaseException as err:
+            current.error = err
+            raise
+        finally:
+            with self.lock:
+                del self.flights[key]
+            current.done.set()
+        return current.result, False
+
+    def wait(self, current):
+        " wait for the `current` flight, tell if it landed "
+        return current.done.wait(self.timeout)
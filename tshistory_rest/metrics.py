@@ -0,0 +1,193 @@
+from bisect import bisect_left
+from collections import defaultdict
+import threading
+import time
+
+from flask import (
+    g,
+    request,
+    Response
+)
+
+
+LATENCY_BUCKETS = (
+    .005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10
+)
+SIZE_BUCKETS = tuple(
+    256 * 4 ** power for power in range(9)  # 256 bytes .. 16 MB
+)
+
+METRICS = {
+    # name -> (type, help)
+    'tshistory_rest_requests_total': (
+        'counter', 'requests by route, method and status code'
+    ),
+    'tshistory_rest_errors_total': (
+        'counter', 'error responses by route and status code'
+    ),
+    'tshistory_rest_request_duration_seconds': (
+        'histogram', 'request latency by route'
+    ),
+    'tshistory_rest_response_size_bytes': (
+        'histogram', 'response body size by route and format '
+        '(streamed responses are not accounted)'
+    ),
+    'tshistory_rest_points_served_total': (
+        'counter', 'series points served by route and format'
+    ),
+    'tshistory_rest_series_points_served_total': (
+        'counter', 'series points served by series name'
+    )
+}
+
+
+def escape(value):
+    return str(value).replace(
+        '\\', '\\\\'
+    ).replace(
+        '\n', '\\n'
+    ).replace(
+        '"', '\\"'
+    )
+
+
+def labelstr(labels):
+    if not labels:
+        return ''
+    return '{{{}}}'.format(
+        ','.join(f'{key}="{escape(val)}"' for key, val in labels)
+    )
+
+
+class registry:
+    """Thread-safe counters and histograms, rendered in the prometheus
+    text exposition format.
+
+    Only the first `maxseries` series names get their own label in
+    the per-series metrics, the others are accounted as `_other`.
+    """
+    __slots__ = ('lock', 'counters', 'histograms', 'seriesnames', 'maxseries')
+
+    def __init__(self, maxseries=100):
+        self.lock = threading.Lock()
+        self.counters = defaultdict(float)  # (name, labels) -> value
+        self.histograms = {}  # (name, labels) -> [buckets, counts, sum]
+        self.seriesnames = set()
+        self.maxseries = maxseries
+
+    def inc(self, name, labels=(), value=1):
+        with self.lock:
+            self.counters[(name, labels)] += value
+
+    def observe(self, name, buckets, value, labels=()):
+        with self.lock:
+            histogram = self.histograms.get((name, labels))
+            if histogram is None:
+                histogram = self.histograms[(name, labels)] = [
+                    buckets, [0] * (len(buckets) + 1), 0
+                ]
+            histogram[1][bisect_left(buckets, value)] += 1
+            histogram[2] += value
+
+    def seriesname(self, name):
+        with self.lock:
+            if name in self.seriesnames:
+                return name
+            if len(self.seriesnames) < self.maxseries:
+                self.seriesnames.add(name)
+                return name
+        return '_other'
+
+    def render(self):
+        lines = []
+        with self.lock:
+            counters = sorted(self.counters.items())
+            histograms = sorted(
+                (key, (buckets, list(counts), total))
+                for key, (buckets, counts, total) in self.histograms.items()
+            )
+        for metric, (kind, doc) in METRICS.items():
+            lines.append(f'# HELP {metric} {doc}')
+            lines.append(f'# TYPE {metric} {kind}')
+            for (name, labels), value in counters:
+                if name == metric:
+                    lines.append(f'{name}{labelstr(labels)} {value:g}')
+            for (name, labels), (buckets, counts, total) in histograms:
+                if name != metric:
+                    continue
+                cumulated = 0
+                for bound, count in zip(buckets + ('+Inf',), counts):
+                    cumulated += count
+                    lines.append(
+                        f'{name}_bucket'
+                        f'{labelstr(labels + (("le", bound),))} {cumulated}'
+                    )
+                lines.append(f'{name}_sum{labelstr(labels)} {total:g}')
+                lines.append(f'{name}_count{labelstr(labels)} {cumulated}')
+        return '\n'.join(lines) + '\n'
+
+
+def install(app, maxseries=100):
+    """instrument the `app` requests and expose the measures on the
+    /metrics route
+
+    """
+    metrics = registry(maxseries)
+
+    @app.before_request
+    def start():
+        g.tshr_start = time.perf_counter()
+
+    @app.after_request
+    def measure(response):
+        if request.endpoint == 'metrics':
+            return response
+        route = request.url_rule.rule if request.url_rule else 'unmatched'
+        status = response.status_code
+        fmt = request.values.get('format') or 'json'
+        metrics.inc(
+            'tshistory_rest_requests_total',
+            (('route', route), ('method', request.method),
+             ('status', str(status)))
+        )
+        if status >= 400:
+            metrics.inc(
+                'tshistory_rest_errors_total',
+                (('route', route), ('status', str(status)))
+            )
+        metrics.observe(
+            'tshistory_rest_request_duration_seconds',
+            LATENCY_BUCKETS,
+            time.perf_counter() - g.tshr_start,
+            (('route', route),)
+        )
+        if not response.is_streamed:
+            metrics.observe(
+                'tshistory_rest_response_size_bytes',
+                SIZE_BUCKETS,
+                response.content_length or 0,
+                (('route', route), ('format', fmt))
+            )
+        points = g.get('tshr_points', {})
+        if points:
+            metrics.inc(
+                'tshistory_rest_points_served_total',
+                (('route', route), ('format', fmt)),
+                sum(points.values())
+            )
+        for name, count in points.items():
+            metrics.inc(
+                'tshistory_rest_series_points_served_total',
+                (('name', metrics.seriesname(name)),),
+                count
+            )
+        return response
+
+    def expose():
+        return Response(
+            metrics.render(),
+            mimetype='text/plain; version=0.0.4'
+        )
+    app.add_url_rule('/metrics', 'metrics', expose)
+
+    return metrics
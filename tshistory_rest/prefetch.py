@@ -0,0 +1,80 @@
+from concurrent.futures import (
+    FIRST_COMPLETED,
+    ThreadPoolExecutor,
+    wait
+)
+
+from tshistory_formula.interpreter import Interpreter
+
+
+class prefetcher:
+    """Reads series concurrently on a thread pool of `workers`
+    threads shared by all the requests, a single request having at
+    most `limit` reads running at once -- so that a formula with a
+    hundred operands leaves room to the others.
+
+    The pool should not be larger than what the database connection
+    pool can serve.
+    """
+    __slots__ = ('executor', 'limit')
+
+    def __init__(self, workers=8, limit=4):
+        self.executor = ThreadPoolExecutor(
+            max_workers=workers,
+            thread_name_prefix='tshistory-rest-prefetch'
+        )
+        self.limit = max(1, limit)
+
+    def fetch(self, read, names):
+        " a dict of name -> read(name) "
+        names = sorted(names, reverse=True)
+        results = {}
+        pending = {}
+        try:
+            while names or pending:
+                while names and len(pending) < self.limit:
+                    name = names.pop()
+                    pending[self.executor.submit(read, name)] = name
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    results[pending.pop(future)] = future.result()
+        finally:
+            for future in pending:
+                future.cancel()
+        return results
+
+
+class prefetched(Interpreter):
+    """A formula interpreter serving the series read with the
+    interpreter arguments from the prefetched `series`, and evaluating
+    the nested `formulas` (name -> text) the same way.
+
+    Reads with other arguments (e.g. shifted by an operator) go to the
+    database as usual.
+    """
+    __slots__ = ('series', 'formulas')
+
+    def __init__(self, cn, tsh, getargs, series, formulas):
+        super().__init__(cn, tsh, getargs)
+        self.series = series
+        self.formulas = formulas
+
+    def get(self, name, getargs):
+        if getargs != self.getargs:
+            return super().get(name, getargs)
+        if name in self.series:
+            ts = self.series[name]
+            # the operators may alter their inputs
+            return None if ts is None else ts.copy()
+        if name in self.formulas:
+            ts = self.tsh.eval_formula(
+                self.cn,
+                self.formulas[name],
+                __interpreter__=prefetched(
+                    self.cn, self.tsh, getargs, self.series, self.formulas
+                )
+            )
+            if ts is not None:
+                ts.name = name
+            return ts
+        return super().get(name, getargs)
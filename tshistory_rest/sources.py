@@ -0,0 +1,86 @@
+from concurrent.futures import (
+    ThreadPoolExecutor,
+    wait
+)
+import logging
+import threading
+from urllib.parse import urlparse
+
+
+L = logging.getLogger('tshistory_rest')
+
+
+def sourcename(source):
+    " the catalog name of a secondary source (without credentials) "
+    parsed = urlparse(source.uri)
+    return (
+        f'db://{parsed.netloc.split("@")[-1]}{parsed.path}'
+        f'!{source.namespace}'
+    )
+
+
+class fanout:
+    """Asks the same question to all the secondary sources at once,
+    waiting at most `timeout` seconds for their answers.
+
+    Each source has its own pool of `workers` threads. A source which
+    does not answer in time keeps its thread until it does; once all
+    its threads are taken, it is not asked any more (status `busy`)
+    until one comes back -- a stuck source cannot starve the others.
+    """
+    __slots__ = ('sources', 'executors', 'slots', 'timeout')
+
+    def __init__(self, sources, workers=4, timeout=5):
+        self.sources = sources
+        self.executors = [
+            ThreadPoolExecutor(
+                max_workers=workers,
+                thread_name_prefix='tshistory-rest-sources'
+            )
+            for _source in sources
+        ]
+        self.slots = [
+            threading.BoundedSemaphore(workers)
+            for _source in sources
+        ]
+        self.timeout = timeout
+
+    def ask(self, question):
+        """a list of (source, answer, status) of `question(source)` in
+        the sources order, the status being `ok`, `timeout`, `busy` or
+        `error` (the answer being None then)
+
+        """
+        futures = []
+        for source, executor, slots in zip(
+                self.sources, self.executors, self.slots):
+            if not slots.acquire(blocking=False):
+                futures.append(None)
+                continue
+            future = executor.submit(question, source)
+            future.add_done_callback(
+                lambda _future, slots=slots: slots.release()
+            )
+            futures.append(future)
+        wait(
+            [future for future in futures if future is not None],
+            timeout=self.timeout
+        )
+        answers = []
+        for source, future in zip(self.sources, futures):
+            if future is None:
+                answers.append((source, None, 'busy'))
+                L.warning('source %s busy', sourcename(source))
+            elif not future.done():
+                future.cancel()
+                answers.append((source, None, 'timeout'))
+                L.warning('source %s timed out', sourcename(source))
+            elif future.exception() is not None:
+                answers.append((source, None, 'error'))
+                L.warning(
+                    'source %s failed', sourcename(source),
+                    exc_info=future.exception()
+                )
+            else:
+                answers.append((source, future.result(), 'ok'))
+        return answers
@@ -1,6 +1,11 @@
+import base64
+import gzip
+import io
 import json
+import struct
 import zlib
 
+import numpy as np
 import pandas as pd
 from tshistory import util
 
@@ -13,6 +18,30 @@ def has_formula():
     return True
 
 
+def has_arrow():
+    try:
+        import pyarrow
+    except ImportError:
+        return False
+    return True
+
+
+def has_zstd():
+    try:
+        import zstandard
+    except ImportError:
+        return False
+    return True
+
+
+def has_a2wsgi():
+    try:
+        import a2wsgi
+    except ImportError:
+        return False
+    return True
+
+
 def utcdt(dtstr):
     return pd.Timestamp(dtstr)
 
@@ -23,6 +52,21 @@ def todict(dictstr):
     return json.loads(dictstr)
 
 
+def encode_cursor(position):
+    " an opaque pagination token from a json-serializable position "
+    return base64.urlsafe_b64encode(
+        json.dumps(position).encode('utf-8')
+    ).decode('ascii')
+
+
+def decode_cursor(cursor):
+    " the reverse of `encode_cursor` "
+    try:
+        return json.loads(base64.urlsafe_b64decode(cursor.encode('ascii')))
+    except ValueError:
+        raise ValueError('bad cursor')
+
+
 def enum(*enum):
     " an enum input type "
 
@@ -34,12 +78,395 @@ def enum(*enum):
     return _str
 
 
-def binary_pack_meta_data(meta, series):
+def offset(rule):
+    " a pandas offset from its alias (e.g. 15min, 1H or 1D) "
+    return pd.tseries.frequencies.to_offset(rule)
+
+
+AGGREGATIONS = ('mean', 'sum', 'min', 'max', 'last')
+
+
+def resample(series, rule, how='mean'):
+    """aggregate the values of `series` over the periods of `rule`,
+    the empty periods being dropped
+
+    """
+    if series is None or not len(series):
+        return series
+    periods = series.resample(rule)
+    if how == 'sum':
+        # or the empty periods would sum to 0
+        return periods.sum(min_count=1).dropna()
+    return getattr(periods, how)().dropna()
+
+
+def binary_pack_meta_data(meta, series, compressor=zlib.compress):
     index, values = util.numpy_serialize(
         series,
         meta['value_type'] == 'object'
     )
     bmeta = json.dumps(meta).encode('utf-8')
-    return zlib.compress(
+    return compressor(
         util.nary_pack(bmeta, index, values)
     )
+
+
+def pack_history(metadata, hist, compressor=zlib.compress):
+    " `tshistory.util.pack_history` with a pluggable compressor "
+    byteslist = [json.dumps(metadata).encode('utf-8')]
+    byteslist.append(
+        np.array(
+            [tstamp.to_datetime64() for tstamp in hist],
+            dtype='datetime64'
+        ).view(np.uint8).data.tobytes()
+    )
+    isstr = metadata['value_type'] == 'object'
+    for series in hist.values():
+        index, values = util.numpy_serialize(
+            series,
+            isstr
+        )
+        byteslist.append(index)
+        byteslist.append(values)
+    return compressor(
+        util.nary_pack(*byteslist)
+    )
+
+
+def pack_insertion_dates(idates, compressor=zlib.compress):
+    " the (utc) insertion dates as a compressed array of int64 ns "
+    return compressor(
+        np.array(
+            [idate.to_datetime64() for idate in idates],
+            dtype='datetime64[ns]'
+        ).view(np.int64).tobytes()
+    )
+
+
+def unpack_insertion_dates(bytestr):
+    " the reverse of `pack_insertion_dates` "
+    return list(
+        pd.to_datetime(
+            np.frombuffer(zlib.decompress(bytestr), dtype=np.int64),
+            utc=True
+        )
+    )
+
+
+# http content encodings
+
+def encodings():
+    " the available content encodings, by order of preference "
+    available = ['gzip', 'deflate']
+    if has_zstd():
+        available.insert(0, 'zstd')
+    return tuple(available)
+
+
+def encode(encoding, bytestr, level=None):
+    """compress `bytestr` according to an http content encoding
+
+    The default levels are the zlib (6) and zstd (3) ones, which trade
+    well cpu for bandwidth on the fly.
+    """
+    if encoding == 'gzip':
+        return gzip.compress(bytestr, 6 if level is None else level)
+    if encoding == 'deflate':
+        return zlib.compress(bytestr, 6 if level is None else level)
+    if encoding == 'zstd':
+        import zstandard
+        return zstandard.ZstdCompressor(
+            level=3 if level is None else level
+        ).compress(bytestr)
+    raise ValueError(f'unknown encoding `{encoding}`')
+
+
+def series_metadata(series):
+    " the internal metadata describing the layout of a series "
+    index = series.index
+    return {
+        'tzaware': util.tzaware_serie(series),
+        'index_type': index.dtype.name,
+        'index_dtype': index.dtype.str,
+        'value_dtype': series.dtypes.str,
+        'value_type': series.dtypes.name
+    }
+
+
+def unpack_series(meta, bindex, bvalues, name=None):
+    " build back a series from its numpy serialized index and values "
+    index, values = util.numpy_deserialize(bindex, bvalues, meta)
+    if not len(index):
+        values = values[:0]
+    if isinstance(values, list):
+        values = np.array(values, dtype='object')
+    series = pd.Series(values, index=index, name=name)
+    if meta['tzaware']:
+        series = series.tz_localize('utc')
+    return series
+
+
+# what the unpacking of a corrupt tshpack payload raises
+UNPACK_ERRORS = (zlib.error, struct.error, ValueError, KeyError, TypeError)
+
+
+def nary_unpack(bytestr):
+    """util.nary_unpack, after a check of the sizes announced by
+    `bytestr` (which may come from the wire)
+
+    """
+    if len(bytestr) < 4:
+        raise ValueError('truncated payload')
+    [count] = struct.unpack('!L', bytestr[:4])
+    offset = 4 + count * 4
+    if offset > len(bytestr):
+        raise ValueError('truncated payload')
+    sizes = struct.unpack(f'!{count}L', bytestr[4:offset])
+    if sum(sizes) != len(bytestr) - offset:
+        raise ValueError('inconsistent payload sizes')
+    return util.nary_unpack(bytestr)
+
+
+def binary_unpack_meta_data(bytestr, name=None):
+    " the reverse of `binary_pack_meta_data` "
+    bmeta, index, values = nary_unpack(
+        zlib.decompress(bytestr)
+    )
+    meta = json.loads(bmeta)
+    return meta, unpack_series(meta, index, values, name)
+
+
+def binary_pack_many(header, entries, compressor=zlib.compress):
+    """pack a json-serializable header followed by (entry, series)
+    pairs, where entry is a json-serializable dict holding the series
+    internal metadata under the `meta` key
+
+    """
+    byteslist = [json.dumps(header).encode('utf-8')]
+    for entry, series in entries:
+        if series is None:
+            index, values = b'', b''
+        else:
+            index, values = util.numpy_serialize(
+                series,
+                entry['meta']['value_type'] == 'object'
+            )
+        byteslist.append(json.dumps(entry).encode('utf-8'))
+        byteslist.append(index)
+        byteslist.append(values)
+    return compressor(
+        util.nary_pack(*byteslist)
+    )
+
+
+def binary_unpack_many(bytestr):
+    " the reverse of `binary_pack_many` "
+    byteslist = nary_unpack(zlib.decompress(bytestr))
+    header = json.loads(byteslist[0])
+    entries = []
+    for bentry, index, values in zip(*[iter(byteslist[1:])] * 3):
+        entry = json.loads(bentry)
+        entries.append(
+            (entry, unpack_series(entry['meta'], index, values, entry.get('name')))
+        )
+    return header, entries
+
+
+def frame(bytestr):
+    " prefix a chunk with its size, to be sent as a part of a stream "
+    return struct.pack('!L', len(bytestr)) + bytestr
+
+
+def iter_frames(bytestr):
+    " the reverse of `frame`, over a concatenation of frames "
+    offset = 0
+    while offset < len(bytestr):
+        [size] = struct.unpack('!L', bytestr[offset:offset + 4])
+        offset += 4
+        yield bytestr[offset:offset + size]
+        offset += size
+
+
+def pack_history_chunk(meta, idate, series, compressor=zlib.compress):
+    " one self-contained revision of a streamed history "
+    index, values = util.numpy_serialize(
+        series,
+        meta['value_type'] == 'object'
+    )
+    return frame(
+        compressor(
+            util.nary_pack(idate.isoformat().encode('utf-8'), index, values)
+        )
+    )
+
+
+def unpack_history_stream(bytestr):
+    """the reverse of a stream of frames (a metadata frame followed by
+    `pack_history_chunk` frames)
+
+    """
+    frames = iter_frames(bytestr)
+    meta = json.loads(next(frames))
+    hist = {}
+    for chunk in frames:
+        bidate, index, values = util.nary_unpack(zlib.decompress(chunk))
+        idate = pd.Timestamp(bidate.decode('utf-8'))
+        hist[idate] = unpack_series(meta, index, values)
+    return meta, hist
+
+
+# apache arrow ipc (stream) format
+
+ARROW_MIMETYPE = 'application/vnd.apache.arrow.stream'
+
+
+def arrow_schema(meta, *indexes):
+    """the arrow schema of a series (or history, with a leading
+    `insertion_date` index, always in utc) described by `meta`, which
+    is kept in the schema metadata
+
+    """
+    import pyarrow as pa
+
+    tz = 'UTC' if meta['tzaware'] else None
+    if meta['value_type'] == 'object':
+        valuetype = pa.string()
+    else:
+        valuetype = pa.from_numpy_dtype(np.dtype(meta['value_dtype']))
+    fields = [
+        pa.field(index, pa.timestamp('ns', tz='UTC'))
+        for index in indexes
+    ] + [
+        pa.field('value_date', pa.timestamp('ns', tz=tz)),
+        pa.field('value', valuetype)
+    ]
+    return pa.schema(
+        fields,
+        metadata={'tshistory': json.dumps(meta)}
+    )
+
+
+def _arrow_batch(schema, series, idate=None):
+    import pyarrow as pa
+
+    if series is None:
+        series = pd.Series([], dtype='float64')
+    columns = [
+        pa.array(series.index.values, type=schema.field('value_date').type),
+        pa.array(series.values, type=schema.field('value').type,
+                 from_pandas=True)
+    ]
+    if idate is not None:
+        idates = np.full(len(series), idate.to_datetime64())
+        columns.insert(
+            0,
+            pa.array(idates, type=schema.field('insertion_date').type)
+        )
+    return pa.record_batch(columns, schema=schema)
+
+
+def _arrow_stream(schema, batches):
+    " yield the bytes of an arrow ipc stream, batch by batch "
+    import pyarrow as pa
+
+    sink = io.BytesIO()
+
+    def flush():
+        chunk = sink.getvalue()
+        sink.seek(0)
+        sink.truncate()
+        return chunk
+
+    with pa.ipc.new_stream(sink, schema) as writer:
+        for batch in batches:
+            writer.write_batch(batch)
+            yield flush()
+    yield flush()
+
+
+def arrow_series(meta, series):
+    " a series as a (value_date, value) arrow ipc stream "
+    schema = arrow_schema(meta)
+    return b''.join(
+        _arrow_stream(schema, [_arrow_batch(schema, series)])
+    )
+
+
+def arrow_history_chunks(meta, items):
+    """yield a history, given as (insertion date, series) items, as a
+    long (insertion_date, value_date, value) arrow ipc stream with one
+    record batch per revision
+
+    """
+    schema = arrow_schema(meta, 'insertion_date')
+    yield from _arrow_stream(
+        schema,
+        (
+            _arrow_batch(schema, series, idate)
+            for idate, series in items
+        )
+    )
+
+
+# columnar json format
+
+def _json_array(values):
+    # the pandas (ujson) encoder does not format point by point in python
+    return pd.Series(values).to_json(orient='values')
+
+
+def columnar_json(series, tzaware):
+    """a compact json encoding of a series: the index comes as an
+    array of epoch milliseconds or, when it is regular, as a start,
+    step and length triple
+
+    """
+    if series is None:
+        return 'null'
+    stamps = series.index.asi8 // 1_000_000
+    head = f'"tzaware": {json.dumps(bool(tzaware))}'
+    steps = np.diff(stamps)
+    if len(steps) and steps[0] > 0 and (steps == steps[0]).all():
+        index = (
+            f'"start": {stamps[0]}, "step": {steps[0]}, '
+            f'"length": {len(stamps)}'
+        )
+    else:
+        index = f'"index": {_json_array(stamps)}'
+    return f'{{{head}, {index}, "values": {_json_array(series.values)}}}'
+
+
+def columnar_series(payload, name=None):
+    " the series of a (decoded) columnar json payload "
+    if payload is None:
+        return None
+    if 'index' in payload:
+        stamps = np.array(payload['index'], dtype='int64')
+    else:
+        stamps = payload['start'] + payload['step'] * np.arange(
+            payload['length'], dtype='int64'
+        )
+    index = pd.to_datetime(stamps, unit='ms')
+    if payload['tzaware']:
+        index = index.tz_localize('UTC')
+    values = payload['values']
+    if any(isinstance(v, str) for v in values):
+        values = np.array(values, dtype='object')
+    else:
+        values = np.array(values, dtype='float64')
+    return pd.Series(values, index=index, name=name)
+
+
+def columnar_history(hist, tzaware):
+    """a history as a json object of insertion date -> columnar series,
+    each revision carrying its own points only
+
+    """
+    if hist is None:
+        return 'null'
+    return '{{{}}}'.format(
+        ', '.join(
+            f'{json.dumps(idate.isoformat())}: {columnar_json(series, tzaware)}'
+            for idate, series in hist.items()
+        )
+    )